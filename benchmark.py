@@ -0,0 +1,379 @@
+# ***********************************************************************
+# Santavaders frame benchmark
+# Copyright (C) 2024 by David Culp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#<https://www.gnu.org/licenses/>.
+# ***********************************************************************
+"""Time each phase of a Santavaders frame at every supported resolution.
+
+Every scenario at every entry of the resolutions table runs in its own
+worker process, because the game sets up its window and scales its images
+once per process.  Each worker drives the game with scripted input, times
+get_input(), update(), detect_collisions(), draw_scene() and
+update_display(), which includes scaling up to the window when the game is
+drawn smaller, separately and reports mean, p50, p95 and p99 in
+milliseconds.  A second, shorter pass runs under tracemalloc and reports
+the peak Python memory growth per frame, the most the traced memory rose
+above its starting size during each phase.  Short lived objects that are
+freed and reused within a phase barely show, and SDL's own surface memory
+is not seen by tracemalloc.
+
+    python benchmark.py                       # headless, every resolution
+    python benchmark.py --window              # draw to a real window
+    python benchmark.py --dirty-rects         # use the dirty rectangle renderer
+    python benchmark.py --compare old.json    # show change against a run
+    python benchmark.py --replay game.rec     # replay a recorded game
+    python benchmark.py --scenario sprite_blits --sprites separate --sprites rle
+    python benchmark.py --resolution 2048x1536 --render-resolution 1024x768 --upscale scale
+"""
+import os
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+
+# The driver only needs the resolutions table, so it imports the game
+# headless.  Workers get their mode and resolution from the driver.
+if "--worker" not in sys.argv:
+    os.environ["SANTAVADERS_HEADLESS"] = "1"
+import santavaders as sv
+
+SCENARIOS = ("full_formation", "heavy_present_fire", "fireplaces_mid_erosion",
+             "game_over_snowfall", "sprite_blits")
+PHASES = ("input", "update", "collisions", "draw", "flip")
+WARMUP_FRAMES = 60
+
+
+#***********************************************************************
+#*                       SCENARIOS                                     *
+#***********************************************************************
+# Each scenario has a setup function that puts the game into the state to
+# measure, and a script that returns the keys held on a given frame.  The
+# game is set up again whenever the player dies so the measured state holds
+# for the whole run.
+
+def sweep_script(frame):
+    """Move back and forth across the screen without firing"""
+    return [sv.pygame.K_RIGHT if (frame // 60) % 2 == 0 else sv.pygame.K_LEFT]
+
+def sweep_and_fire_script(frame):
+    keys = sweep_script(frame)
+    if frame % 25 == 0:
+        keys.append(sv.pygame.K_SPACE)
+    return keys
+
+def fire_script(frame):
+    return [sv.pygame.K_SPACE] if frame % 25 == 0 else []
+
+def setup_full_formation():
+    sv.reset_game(True)
+
+def setup_heavy_present_fire():
+    for level in sv.level_data:
+        level["invader_shot_chance"] = 40
+    sv.reset_game(True)
+
+def setup_fireplaces_mid_erosion():
+    for level in sv.level_data:
+        level["invader_shot_chance"] = 10
+    sv.reset_game(True)
+    # knock a few holes in every fireplace and park the player under the
+    # first one so the star keeps eroding it
+    rng = random.Random(1)
+    radius = sv.explosion_graphics[0].get_width() // 4
+    for fireplace in sv.fireplaces:
+        for _ in range(6):
+            x = fireplace["x"] + rng.randint(0, sv.fireplace_width)
+            y = fireplace["y"] + rng.randint(0, sv.fireplace_height)
+            sv.erode_fireplace(fireplace, (x, y), radius)
+    first = sv.fireplaces[0]
+    sv.player_rect.centerx = int(first["x"] + sv.fireplace_width // 2)
+
+def setup_game_over_snowfall():
+    sv.reset_game(False)
+    sv.game_data["game_state"] = sv.GAME_STATE_HIGH_SCORES
+
+def setup_sprite_blits():
+    """Scatter every sprite over the screen a few times, nothing else moves"""
+    global sprite_blits
+    sv.reset_game(True)
+    rng = random.Random(1)
+    sprite_blits = [(image, (rng.randrange(sv.SCREEN_WIDTH - image.get_width()),
+                             rng.randrange(sv.SCREEN_HEIGHT - image.get_height())))
+                    for _ in range(5) for image in sv.assets.images.values()]
+
+def sprite_blits_phases(frame):
+    return (("draw", lambda: sv.screen.blits(sprite_blits, False)),)
+
+def gameplay_phases(script):
+    def phases(frame):
+        keys = sv.ScriptedKeys(script(frame))
+        return (("input", lambda: sv.get_input(keys)),
+                ("update", sv.update),
+                ("collisions", sv.detect_collisions),
+                ("draw", sv.draw_scene),
+                ("flip", sv.update_display))
+    return phases
+
+def game_over_phases(frame):
+    return (("update", sv.update_game_over_snow),
+            ("draw", lambda: sv.draw_game_over_screen(high_scores, "benchmark", 0)),
+            ("flip", sv.present))
+
+def replay_scenario(filename):
+    """Play a recorded game from its start, over and over"""
+    recording = sv.InputRecording.load(filename)
+    position = [0]
+
+    def setup():
+        sv.random.seed(recording.seed)
+        sv.reset_game(True)
+        position[0] = 0
+
+    def script(frame):
+        bits = recording.inputs[position[0] % len(recording.inputs)]
+        position[0] += 1
+        return sv.keys_for_bits(bits)
+    return setup, gameplay_phases(script)
+
+def get_scenario(name, replay_file=None):
+    """Return the (setup, phases) functions for the named scenario"""
+    if name == "replay":
+        return replay_scenario(replay_file)
+    if name == "full_formation":
+        return setup_full_formation, gameplay_phases(sweep_script)
+    if name == "heavy_present_fire":
+        return setup_heavy_present_fire, gameplay_phases(sweep_and_fire_script)
+    if name == "fireplaces_mid_erosion":
+        return setup_fireplaces_mid_erosion, gameplay_phases(fire_script)
+    if name == "game_over_snowfall":
+        return setup_game_over_snowfall, game_over_phases
+    if name == "sprite_blits":
+        return setup_sprite_blits, sprite_blits_phases
+    raise ValueError("unknown scenario %r" % name)
+
+
+#***********************************************************************
+#*                       WORKER                                        *
+#***********************************************************************
+def run_frames(setup, phases, frames, track_memory):
+    """Run frames frames and return the per-phase samples and restart count.
+
+    Samples are milliseconds, or the peak growth in traced Python memory in
+    bytes when track_memory is set.
+    """
+    samples = {}
+    restarts = 0
+    expected_state = sv.game_data["game_state"]
+    for frame in range(frames):
+        sv.advance_game_clock()
+        for name, phase in phases(frame):
+            if track_memory:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                phase()
+                sample = tracemalloc.get_traced_memory()[1] - before
+            else:
+                start = time.perf_counter()
+                phase()
+                sample = (time.perf_counter() - start) * 1000
+            samples.setdefault(name, []).append(sample)
+        if sv.game_data["game_state"] == sv.GAME_STATE_LEVEL_OVER:
+            # a windowed game waits before the next level, skip that
+            sv.game_data["game_state"] = sv.GAME_STATE_RUNNING
+            sv.start_next_level()
+        if sv.game_data["game_state"] != expected_state:
+            setup()
+            restarts += 1
+        elif expected_state == sv.GAME_STATE_RUNNING:
+            sv.check_level_end()
+    return samples, restarts
+
+def summarize(samples):
+    if len(samples) < 2:
+        samples = samples * 2
+    cuts = statistics.quantiles(samples, n=100)
+    return {"mean": statistics.fmean(samples), "p50": cuts[49],
+            "p95": cuts[94], "p99": cuts[98]}
+
+def run_worker(scenario, frames, replay_file=None):
+    global high_scores
+    setup, phases = get_scenario(scenario, replay_file)
+    high_scores = sv.high_score_store.load()
+    setup()
+
+    run_frames(setup, phases, WARMUP_FRAMES, False)
+    timings, restarts = run_frames(setup, phases, frames, False)
+
+    tracemalloc.start()
+    peak_growth, _ = run_frames(setup, phases, min(frames, 300), True)
+    tracemalloc.stop()
+
+    frame_times = [sum(phase_times) for phase_times in zip(*timings.values())]
+    frame_bytes = [sum(phase_bytes) for phase_bytes in zip(*peak_growth.values())]
+    return {
+        "resolution": "%dx%d" % (sv.WINDOW_WIDTH, sv.WINDOW_HEIGHT),
+        "scenario": scenario if replay_file is None else os.path.basename(replay_file),
+        "sprites": sv.SPRITE_MODE,
+        "render": ("%dx%d %s" % (sv.SCREEN_WIDTH, sv.SCREEN_HEIGHT, sv.render_data["upscaler"])
+                   if sv.UPSCALING else "native"),
+        "sprite_bytes": sv.assets.memory_used,
+        "frames": frames,
+        "restarts": restarts,
+        "phases_ms": {name: summarize(times) for name, times in timings.items()},
+        "frame_ms": summarize(frame_times),
+        "peak_growth_bytes_per_frame": {
+            "phases": {name: statistics.fmean(sizes) for name, sizes in peak_growth.items()},
+            "frame": statistics.fmean(frame_bytes),
+        },
+    }
+
+
+#***********************************************************************
+#*                       DRIVER                                        *
+#***********************************************************************
+def run_case(resolution, scenario, frames, window, dirty_rects, sprites, render=None,
+             replay_file=None):
+    """Benchmark one resolution and scenario in a fresh worker process.
+
+    render is the (render resolution, upscaler) to draw with, or None to
+    draw at the window's resolution.
+    """
+    env = dict(os.environ, SANTAVADERS_RESOLUTION=resolution, SANTAVADERS_SEED="0",
+               SANTAVADERS_HEADLESS="0" if window else "1",
+               SANTAVADERS_DIRTY_RECTS="1" if dirty_rects else "0",
+               SANTAVADERS_SPRITES=sprites)
+    env.pop("SANTAVADERS_RENDER_RESOLUTION", None)
+    if render is not None:
+        env["SANTAVADERS_RENDER_RESOLUTION"], env["SANTAVADERS_UPSCALE"] = render
+    command = [sys.executable, os.path.abspath(__file__), "--worker",
+               "--scenario", scenario, "--frames", str(frames)]
+    if replay_file is not None:
+        command += ["--replay", os.path.abspath(replay_file)]
+    output = subprocess.run(command, env=env, check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.splitlines()[-1])
+
+def print_result(result):
+    frame = result["frame_ms"]
+    print(f"{result['resolution']:>9} {result['scenario']:<24} {result['sprites']:<9} "
+          f"{result['render']:<20} mean {frame['mean']:7.3f}  p50 {frame['p50']:7.3f}  p95 {frame['p95']:7.3f}  "
+          f"p99 {frame['p99']:7.3f} ms  {result['peak_growth_bytes_per_frame']['frame']/1024:8.1f} KiB peak/frame  "
+          f"sprites {result['sprite_bytes']/1024:6.0f} KiB")
+    for name in PHASES:
+        if name in result["phases_ms"]:
+            phase = result["phases_ms"][name]
+            print(f"{'':>9}   {name:<53} mean {phase['mean']:7.3f}  p50 {phase['p50']:7.3f}  "
+                  f"p95 {phase['p95']:7.3f}  p99 {phase['p99']:7.3f}")
+
+def print_comparison(results, baseline):
+    """Print the change in frame time percentiles against a saved run"""
+    # results from before the sprite modes were all separate surfaces
+    old_results = {(r["resolution"], r["scenario"], r.get("sprites", "separate"),
+                    r.get("render", "native")): r
+                   for r in baseline["results"]}
+    print("\nChange against baseline (negative is faster):")
+    for result in results:
+        old = old_results.get((result["resolution"], result["scenario"], result["sprites"],
+                               result["render"]))
+        if old is None:
+            continue
+        changes = []
+        for stat in ("mean", "p50", "p95", "p99"):
+            before = old["frame_ms"][stat]
+            after = result["frame_ms"][stat]
+            changes.append(f"{stat} {(after - before) / before * 100 if before else 0:+6.1f}%")
+        print(f"{result['resolution']:>9} {result['scenario']:<24} {result['sprites']:<9} "
+              f"{result['render']:<20} " + "  ".join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description="Santavaders frame benchmark")
+    parser.add_argument("--frames", type=int, default=600,
+                        help="measured frames per resolution and scenario")
+    parser.add_argument("--resolution", action="append",
+                        help="only run this resolution, e.g. 1024x768 (repeatable)")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS + ("replay",),
+                        help="only run this scenario (repeatable)")
+    parser.add_argument("--window", action="store_true",
+                        help="draw to a real window instead of SDL's dummy driver")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="use the dirty rectangle renderer")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="file the JSON results are written to")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--replay", action="append", default=[],
+                        help="also replay this recorded game at its own resolution (repeatable)")
+    parser.add_argument("--sprites", action="append", choices=sv.SPRITE_MODES,
+                        help="run with this sprite mode, by default the game's (repeatable)")
+    parser.add_argument("--render-resolution",
+                        help="also draw at this smaller resolution and scale up to the window")
+    parser.add_argument("--upscale", action="append", choices=sv.UPSCALERS,
+                        help="upscaler used with --render-resolution, default scale (repeatable)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        replay_file = args.replay[0] if args.replay else None
+        print(json.dumps(run_worker(args.scenario[0], args.frames, replay_file)))
+        return
+
+    resolutions = args.resolution or ["%dx%d" % entry[:2] for entry in sv.resolutions]
+    # replays run once per --replay file, at the resolution they were recorded at
+    scenarios = [name for name in args.scenario or SCENARIOS if name != "replay"]
+    sprite_modes = args.sprites or [sv.SPRITE_MODE]
+    # each resolution is drawn natively and then at --render-resolution
+    # with each upscaler, where it is smaller than the window
+    renders = [None]
+    if args.render_resolution:
+        renders += [(args.render_resolution, upscaler) for upscaler in args.upscale or ["scale"]]
+    render_width = int(args.render_resolution.split("x")[0]) if args.render_resolution else 0
+    results = []
+    for resolution in resolutions:
+        for scenario in scenarios:
+            for sprites in sprite_modes:
+                for render in renders:
+                    if render is not None and render_width >= int(resolution.split("x")[0]):
+                        continue
+                    result = run_case(resolution, scenario, args.frames, args.window,
+                                      args.dirty_rects, sprites, render)
+                    print_result(result)
+                    results.append(result)
+    for replay_file in args.replay:
+        resolution = sv.InputRecording.load(replay_file).resolution
+        for sprites in sprite_modes:
+            result = run_case(resolution, "replay", args.frames, args.window, args.dirty_rects,
+                              sprites, replay_file=replay_file)
+            print_result(result)
+            results.append(result)
+
+    with open(args.output, "w") as file:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "window": args.window,
+                   "dirty_rects": args.dirty_rects,
+                   "frames": args.frames,
+                   "python": sys.version.split()[0],
+                   "pygame": sv.pygame.version.ver,
+                   "results": results}, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# ***********************************************************************
+# Santavaders difficulty analysis
+# Copyright (C) 2024 by David Culp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#<https://www.gnu.org/licenses/>.
+# ***********************************************************************
+"""Measure how hard each level is by playing it many times headless.
+
+Every game starts at the beginning of one level and ends when the level
+is cleared, the player is hit, the invaders reach the player or
+--max-steps run out.  The games are spread over one worker process per
+core and played by a scripted or random policy.  For each level and
+setting the report gives:
+
+- how each game ended;
+- how long the player survived;
+- the step at which the invaders reached the fireplaces and the player;
+- how much of the fireplaces was shot away, and how fast;
+- the score distribution.
+
+A parameter of level_data can be swept to see how it changes all of that.
+
+    python difficulty.py --games 1000                      # every level as it is
+    python difficulty.py --level 2 --sweep invader_shot_chance=1,2,4,8
+    python difficulty.py --set present_speed=12 --policy demo
+"""
+import os
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import json
+import time
+import random
+import argparse
+import statistics
+import concurrent.futures
+import multiprocessing
+
+os.environ["SANTAVADERS_HEADLESS"] = "1"
+import santavaders as sv
+
+POLICIES = ("random", "demo")
+OUTCOMES = ("cleared", "hit", "invaded", "timeout")
+GAMES_PER_TASK = 25  # games a worker plays per task, to keep messages few
+
+
+#***********************************************************************
+#*                       POLICIES                                      *
+#***********************************************************************
+# A policy is made per game from that game's seed and returns the keys to
+# hold on each step.  Policies have their own random numbers so they never
+# change what the game itself rolls.
+
+def random_policy(seed):
+    """Walk one way or the other for a while at a time, firing now and then"""
+    rng = random.Random(seed)
+    state = {"keys": [], "until": 0}
+
+    def policy(step):
+        if step >= state["until"]:
+            state["keys"] = rng.choice(([], [sv.pygame.K_LEFT], [sv.pygame.K_RIGHT]))
+            state["until"] = step + rng.randint(10, 60)
+        if rng.randrange(20) == 0:
+            return state["keys"] + [sv.pygame.K_SPACE]
+        return state["keys"]
+    return policy
+
+def demo_policy(seed):
+    return sv.demo_script
+
+POLICY_MAKERS = {"random": random_policy, "demo": demo_policy}
+
+
+#***********************************************************************
+#*                       WORKER                                        *
+#***********************************************************************
+def start_level(level):
+    """Start a new game at the beginning of level"""
+    sv.reset_game(False)
+    sv.game_data["current_level"] = level - 1
+    sv.start_next_level()
+
+def fireplace_damage():
+    """Return the mean fraction of the fireplaces that has been shot away"""
+    return sum(sv.fireplace_damage(fireplace) for fireplace in sv.fireplaces) / len(sv.fireplaces)
+
+def play_game(level, policy, max_steps):
+    """Play one game of level and return what happened in it"""
+    start_level(level)
+    result = {"outcome": "timeout", "steps": max_steps,
+              "reached_fireplaces": None, "reached_player": None}
+    for step in range(max_steps):
+        sv.advance_game_clock()
+        sv.get_input(sv.ScriptedKeys(policy(step)))
+        sv.update()
+        sv.detect_collisions()
+        if result["reached_fireplaces"] is None and not sv.game_data["fireplaces_active"]:
+            result["reached_fireplaces"] = step + 1
+        state = sv.game_data["game_state"]
+        if state != sv.GAME_STATE_RUNNING:
+            # update() ends the game when the invaders reach the player,
+            # detect_collisions() when something hits the player
+            if state == sv.GAME_STATE_GAME_OVER:
+                result["outcome"] = "invaded"
+                result["reached_player"] = step + 1
+            else:
+                result["outcome"] = "hit"
+            result["steps"] = step + 1
+            break
+        if not sv.invaders.alive:
+            result["outcome"] = "cleared"
+            result["steps"] = step + 1
+            break
+    result["score"] = sv.game_data["player_score"]
+    result["fireplace_damage"] = fireplace_damage()
+    return result
+
+def play_games(level, overrides, seeds, policy_name, max_steps):
+    """Play a game of level for each seed with level_data changed by overrides"""
+    original = dict(sv.level_data[level])
+    sv.level_data[level].update(overrides)
+    try:
+        results = []
+        for seed in seeds:
+            sv.random.seed(seed)
+            results.append(play_game(level, POLICY_MAKERS[policy_name](seed), max_steps))
+        return results
+    finally:
+        sv.level_data[level] = original
+
+
+#***********************************************************************
+#*                       REPORT                                        *
+#***********************************************************************
+def distribution(values):
+    """Return mean and percentiles of values, or None if there are none"""
+    if not values:
+        return None
+    if len(values) < 2:
+        values = values * 2
+    cuts = statistics.quantiles(values, n=20)
+    return {"mean": statistics.fmean(values), "p5": cuts[0], "p25": cuts[4],
+            "p50": cuts[9], "p75": cuts[14], "p95": cuts[18]}
+
+def summarize(results):
+    games = len(results)
+    seconds = [result["steps"] * sv.SIM_STEP_MS / 1000 for result in results]
+    return {
+        "games": games,
+        "outcomes": {outcome: sum(result["outcome"] == outcome for result in results) / games
+                     for outcome in OUTCOMES},
+        "survival_s": distribution(seconds),
+        "reached_fireplaces": {
+            "rate": sum(result["reached_fireplaces"] is not None for result in results) / games,
+            "step": distribution([result["reached_fireplaces"] for result in results
+                                  if result["reached_fireplaces"] is not None])},
+        "reached_player": {
+            "rate": sum(result["reached_player"] is not None for result in results) / games,
+            "step": distribution([result["reached_player"] for result in results
+                                  if result["reached_player"] is not None])},
+        "fireplace_damage": distribution([result["fireplace_damage"] for result in results]),
+        "fireplace_damage_per_min": distribution([result["fireplace_damage"] * 60 / s
+                                                  for result, s in zip(results, seconds)]),
+        "score": distribution([result["score"] for result in results]),
+    }
+
+def print_summary(level, overrides, summary):
+    setting = ", ".join(f"{name}={value}" for name, value in overrides.items()) or "as is"
+    outcomes = "  ".join(f"{outcome} {rate:4.0%}" for outcome, rate in summary["outcomes"].items())
+    survival = summary["survival_s"]
+    score = summary["score"]
+    damage = summary["fireplace_damage"]
+    print(f"level {level + 1}  {setting:<28} {outcomes}")
+    print(f"{'':9}survival p50 {survival['p50']:6.1f}s  p95 {survival['p95']:6.1f}s  "
+          f"score p50 {score['p50']:6.0f}  p95 {score['p95']:6.0f}  "
+          f"fireplaces hit {damage['mean']:4.0%}  "
+          f"reached fireplaces {summary['reached_fireplaces']['rate']:4.0%}")
+
+
+#***********************************************************************
+#*                       DRIVER                                        *
+#***********************************************************************
+def parse_value(text):
+    return float(text) if "." in text else int(text)
+
+def parse_setting(text):
+    """Parse name=value, checking the name is a level_data field"""
+    name, _, value = text.partition("=")
+    if name not in sv.level_data[0]:
+        raise argparse.ArgumentTypeError(f"{name} is not a level_data field")
+    return name, value
+
+def main():
+    parser = argparse.ArgumentParser(description="Santavaders difficulty analysis")
+    parser.add_argument("--games", type=int, default=200,
+                        help="games played per level and setting")
+    parser.add_argument("--level", type=int, action="append",
+                        help="only analyse this level, counting from 1 (repeatable)")
+    parser.add_argument("--set", type=parse_setting, action="append", default=[],
+                        help="change a level_data field, e.g. invader_speed=3 (repeatable)")
+    parser.add_argument("--sweep", type=parse_setting,
+                        help="try each of a list of values, e.g. present_speed=6,8,10")
+    parser.add_argument("--policy", choices=POLICIES, default="random")
+    parser.add_argument("--max-steps", type=int, default=60 * 60 * 10,
+                        help="steps before a game is stopped (default ten minutes)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="difficulty_report.json",
+                        help="file the JSON report is written to")
+    args = parser.parse_args()
+
+    levels = [level - 1 for level in args.level] if args.level else range(len(sv.level_data))
+    fixed = {name: parse_value(value) for name, value in args.set}
+    settings = [fixed]
+    if args.sweep:
+        name, values = args.sweep
+        settings = [dict(fixed, **{name: parse_value(value)}) for value in values.split(",")]
+    seeds = [args.seed + i for i in range(args.games)]
+
+    start_time = time.perf_counter()
+    report = []
+    # each worker imports its own copy of the game
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+        jobs = []
+        for level in levels:
+            for overrides in settings:
+                tasks = [pool.submit(play_games, level, overrides,
+                                     seeds[i:i + GAMES_PER_TASK], args.policy, args.max_steps)
+                         for i in range(0, len(seeds), GAMES_PER_TASK)]
+                jobs.append((level, overrides, tasks))
+        for level, overrides, tasks in jobs:
+            results = [result for task in tasks for result in task.result()]
+            summary = summarize(results)
+            print_summary(level, overrides, summary)
+            report.append({"level": level + 1,
+                           "level_data": dict(sv.level_data[level], **overrides),
+                           "summary": summary})
+    elapsed = time.perf_counter() - start_time
+    games = len(report) * len(seeds)
+    print(f"Played {games} games in {elapsed:.1f}s on {args.workers} workers")
+
+    with open(args.output, "w") as file:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "policy": args.policy,
+                   "games": args.games,
+                   "max_steps": args.max_steps,
+                   "seed": args.seed,
+                   "resolution": "%dx%d" % (sv.SCREEN_WIDTH, sv.SCREEN_HEIGHT),
+                   "elapsed_s": elapsed,
+                   "results": report}, file, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,34 +14,678 @@
 #<https://www.gnu.org/licenses/>.
 # ***********************************************************************
 import os
+import time
+STARTUP_START = time.perf_counter()  # startup is timed from here
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame
+import pygame._sdl2.video
 import math
-import time
+import array
 import random
 import datetime
 import glob 
 import getpass
 import sys
+import argparse
+import collections
+import csv
+import io
+import concurrent.futures
+import queue
+import threading
+import struct
+import zlib
+import uuid
+import contextlib
+import weakref
+try:
+    import numpy
+except ImportError:  # the snow falls back to plain Python lists
+    numpy = None
+try:
+    import fcntl
+except ImportError:  # Windows locks files with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+
+#***********************************************************************
+#*                       INVADER FORMATION                             *
+#***********************************************************************
+class InvaderFormation:
+    """The grid of invaders kept in flat arrays indexed by row*cols + col.
+
+    Alive counts per row and column are kept up to date as invaders are
+    killed, so the alive count and the leftmost, rightmost and lowest alive
+    column/row are available without scanning the grid.
+    """
+
+    def __init__(self, rows=5, cols=11):
+        self.rows = rows
+        self.cols = cols
+        size = rows * cols
+        self.active = bytearray(b"\x01" * size)
+        self.exploding = bytearray(size)
+        self.explode_frame = array.array("B", bytes(size))
+        self.explode_time = array.array("d", [0.0]) * size
+        self.row_counts = array.array("H", [cols]) * rows
+        self.col_counts = array.array("H", [rows]) * cols
+        self.alive = size
+        self.leftmost_col = 0
+        self.rightmost_col = cols - 1
+        self.lowest_row = rows - 1
+
+    def is_active(self, row, col):
+        return self.active[row*self.cols + col]
+
+    def kill(self, row, col, explode=True):
+        """Deactivate the invader at row, col and optionally start it exploding"""
+        index = row*self.cols + col
+        if not self.active[index]:
+            return
+        self.active[index] = 0
+        self.alive -= 1
+        self.row_counts[row] -= 1
+        self.col_counts[col] -= 1
+        if explode:
+            self.exploding[index] = 1
+            self.explode_frame[index] = 0
+            self.explode_time[index] = game_time()
+        # the extents only move when a whole row or column has been cleared
+        if self.row_counts[row] == 0 or self.col_counts[col] == 0:
+            self.update_extents()
+
+    def clear(self):
+        """Deactivate every invader without exploding them"""
+        for index in range(len(self.active)):
+            self.active[index] = 0
+        for row in range(self.rows):
+            self.row_counts[row] = 0
+        for col in range(self.cols):
+            self.col_counts[col] = 0
+        self.alive = 0
+        self.update_extents()
+
+    def update_extents(self):
+        alive_cols = [col for col in range(self.cols) if self.col_counts[col]]
+        alive_rows = [row for row in range(self.rows) if self.row_counts[row]]
+        self.leftmost_col = alive_cols[0] if alive_cols else -1
+        self.rightmost_col = alive_cols[-1] if alive_cols else -1
+        self.lowest_row = alive_rows[-1] if alive_rows else -1
+
+    def active_cells(self):
+        """Yield (row, col) for every active invader in row order"""
+        cols = self.cols
+        for index, active in enumerate(self.active):
+            if active:
+                yield divmod(index, cols)
+
+    def nth_active(self, n):
+        """Return (row, col) of the n-th active invader in row order"""
+        for cell in self.active_cells():
+            if n == 0:
+                return cell
+            n -= 1
+        raise IndexError("formation has fewer than %d active invaders" % (n + 1))
+
+#***********************************************************************
+#*                       ENTITY POOLS                                  *
+#***********************************************************************
+class Entity:
+    """One reusable present or explosion.
+
+    frame and time are for explosions.  prev_x and prev_y hold the position
+    before the last simulation step so drawing can blend between the two.
+    """
+    __slots__ = ("active", "rect", "frame", "time", "prev_x", "prev_y")
+
+    def __init__(self, width, height):
+        self.active = False
+        self.rect = pygame.Rect(0, 0, width, height)
+        self.prev_x = 0
+        self.prev_y = 0
+        self.frame = 0
+        self.time = 0.0
+
+class EntityPool:
+    """A fixed number of entities that are reused instead of reallocated.
+
+    The live entities are always the first count entries of entities.
+    Entities are killed by clearing their active flag, and compact() moves
+    the survivors back to the front in their original order, so a frame in
+    steady state allocates nothing.
+    """
+
+    def __init__(self, capacity, width, height):
+        self.entities = [Entity(width, height) for _ in range(capacity)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        entities = self.entities
+        for i in range(self.count):
+            yield entities[i]
+
+    def spawn(self, x, y, time=0.0):
+        """Activate a free entity with its upper left at x, y.
+
+        Returns None when the pool is full.
+        """
+        if self.count == len(self.entities):
+            return None
+        entity = self.entities[self.count]
+        self.count += 1
+        entity.active = True
+        entity.rect.x = x
+        entity.rect.y = y
+        entity.prev_x = entity.rect.x
+        entity.prev_y = entity.rect.y
+        entity.frame = 0
+        entity.time = time
+        return entity
+
+    def compact(self):
+        """Move the active entities to the front, keeping their order"""
+        entities = self.entities
+        live = 0
+        for i in range(self.count):
+            entity = entities[i]
+            if entity.active:
+                if i != live:
+                    entities[i], entities[live] = entities[live], entity
+                live += 1
+        self.count = live
+
+    def clear(self):
+        for i in range(self.count):
+            self.entities[i].active = False
+        self.count = 0
 
-print("Welcome to Santavaders!")
-print("DO NOT CLOSE THIS WINDOW WHILE GAME IS PLAYING")
-print("Left and Right = Arrow Keys")
-print("Fire = SPACE bar or UP arrow")
-print("Display framerate = 'F' key")
+#***********************************************************************
+#*                       SNOW PARTICLES                                *
+#***********************************************************************
+class SnowParticles:
+    """Falling snowflakes kept in arrays and drawn with one blits() call.
+
+    Positions, speeds and sizes are NumPy arrays that are moved and wrapped
+    in one vectorized step.  Each flake size has a pre-rendered sprite.
+    Without NumPy the same arrays are plain lists.  The snow has its own
+    random generator so that it never changes the game's random sequence.
+    """
+    SIZES = (2, 3, 4, 5)
+
+    def __init__(self, count, width, height, scale, seed):
+        self.count = count
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.sprites = []
+        for size in self.SIZES:
+            sprite = pygame.Surface((size*2 + 1, size*2 + 1), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, (255, 255, 255), (size, size), size)
+            self.sprites.append(sprite.convert_alpha())
+        if numpy is not None:
+            self.rng = numpy.random.default_rng(seed)
+            self.x = self.rng.integers(0, width, count, endpoint=True).astype(float)
+            self.y = self.rng.integers(0, height, count, endpoint=True).astype(float)
+            self.size = self.rng.integers(0, len(self.SIZES), count)
+            self.speed = self.rng.uniform(1, 3, count)
+        else:
+            self.rng = random.Random(seed)
+            self.x = [float(self.rng.randint(0, width)) for _ in range(count)]
+            self.y = [float(self.rng.randint(0, height)) for _ in range(count)]
+            self.size = [self.rng.randrange(len(self.SIZES)) for _ in range(count)]
+            self.speed = [self.rng.uniform(1, 3) for _ in range(count)]
+
+    def update(self):
+        """Move every flake down and restart the ones that left the screen"""
+        if numpy is not None:
+            self.y += self.speed * self.scale
+            wrapped = numpy.flatnonzero(self.y > self.height)
+            if wrapped.size:
+                self.y[wrapped] = 0
+                self.x[wrapped] = self.rng.integers(0, self.width, wrapped.size, endpoint=True)
+                self.size[wrapped] = self.rng.integers(0, len(self.SIZES), wrapped.size)
+                self.speed[wrapped] = self.rng.uniform(1, 3, wrapped.size)
+            return
+        for i in range(self.count):
+            self.y[i] += self.speed[i] * self.scale
+            if self.y[i] > self.height:
+                self.y[i] = 0
+                self.x[i] = float(self.rng.randint(0, self.width))
+                self.size[i] = self.rng.randrange(len(self.SIZES))
+                self.speed[i] = self.rng.uniform(1, 3)
+
+    def draw(self, surface, return_rects=False):
+        """Blit every flake centred on its position in one blits() call"""
+        if numpy is not None:
+            radius = numpy.take(self.SIZES, self.size)
+            xs = (self.x.astype(int) - radius).tolist()
+            ys = (self.y.astype(int) - radius).tolist()
+            sizes = self.size.tolist()
+        else:
+            xs = [int(x) - self.SIZES[size] for x, size in zip(self.x, self.size)]
+            ys = [int(y) - self.SIZES[size] for y, size in zip(self.y, self.size)]
+            sizes = self.size
+        sprites = self.sprites
+        return surface.blits([(sprites[size], (x, y)) for size, x, y in zip(sizes, xs, ys)],
+                             doreturn=return_rects)
 
+#***********************************************************************
+#*                       ASSET MANAGER                                 *
+#***********************************************************************
+class AssetManager:
+    """Loads and scales each sprite image once and keeps it in memory.
+
+    Images are kept by filename, so changing levels is a dictionary lookup.
+    When memory_cap (in bytes) is set, the least recently used level images
+    are dropped once the cap is passed and loaded again if they are needed.
+    Only level images are dropped, because the game keeps every other
+    sprite in a global and dropping it here would free nothing.  The level
+    image in use is always kept.
+    Once loaded, pack() can move the images into one atlas surface and
+    accelerate() can switch them to SDL's run length encoded blits.
+    """
+
+    def __init__(self, scale, memory_cap=None):
+        self.scale = scale
+        self.memory_cap = memory_cap
+        self.images = collections.OrderedDict()
+        self.evictable = set(level["image_file"] for level in level_data)
+        self.memory_used = 0
+        self.atlas = None
+
+    def load(self, filename):
+        """Return the scaled image for filename, loading it if needed"""
+        image = self.images.get(filename)
+        if image is not None:
+            self.images.move_to_end(filename)
+            return image
+        return self.add(filename, load_image(filename, self.scale, self.scale))
+
+    def add(self, filename, image):
+        """Keep image, already scaled, as the image for filename"""
+        self.images[filename] = image
+        self.memory_used += image.get_width() * image.get_height() * image.get_bytesize()
+        self.enforce_memory_cap()
+        return image
+
+    def preload(self, filenames):
+        for filename in filenames:
+            self.load(filename)
+
+    def level_image(self, level):
+        """Return the invader image for the level at index level"""
+        return self.load(level_data[level]["image_file"])
+
+    def pack(self):
+        """Copy every image into one atlas surface and keep subsurfaces of it.
+
+        The images are laid out on shelves at the width that wastes the
+        least room, and their pixels are unchanged.  The memory cap no
+        longer applies, because dropping one image frees none of the atlas.
+        """
+        sizes = [image.get_size() for image in self.images.values()]
+        area = sum(width * height for width, height in sizes)
+        widest = max(width for width, _ in sizes)
+        best = None
+        for width in range(widest, max(widest, int(math.sqrt(area) * 2)) + 1, 8):
+            positions, height = pack_shelves(sizes, width)
+            if best is None or width * height < best[0] * best[1]:
+                best = (width, height, positions)
+        width, height, positions = best
+        self.atlas = pygame.Surface((width, height), pygame.SRCALPHA).convert_alpha()
+        for (filename, image), position in zip(list(self.images.items()), positions):
+            # the atlas starts fully transparent, so MAX copies the pixels as they are
+            self.atlas.blit(image, position, special_flags=pygame.BLEND_RGBA_MAX)
+            self.images[filename] = self.atlas.subsurface(position, image.get_size())
+        self.memory_used = width * height * self.atlas.get_bytesize()
+        self.memory_cap = None
+
+    def accelerate(self, skip=()):
+        """Run length encode every image but the filenames in skip.
+
+        SDL then blits only the runs of visible pixels.  Images with hard
+        edges are given a colorkey instead of per pixel alpha, so they are
+        copied without any blending.  Images that get drawn on must be
+        skipped, because SDL decodes and encodes them again for every change.
+        """
+        for filename, image in list(self.images.items()):
+            if filename in skip:
+                continue
+            if has_hard_edges(image):
+                keyed = pygame.Surface(image.get_size()).convert()
+                keyed.fill(COLORKEY)
+                keyed.blit(image, (0, 0))
+                keyed.set_colorkey(COLORKEY, pygame.RLEACCEL)
+                self.images[filename] = keyed
+                self.memory_used += keyed.get_width() * keyed.get_height() * keyed.get_bytesize()
+                # a sprite in the atlas still holds its place there
+                if image.get_parent() is None:
+                    self.memory_used -= image.get_width() * image.get_height() * image.get_bytesize()
+            else:
+                image.set_alpha(255, pygame.RLEACCEL)
+        self.enforce_memory_cap()
+
+    def enforce_memory_cap(self):
+        if self.memory_cap is None:
+            return
+        # the most recently used level image is the one on screen, so it
+        # stays even if it is bigger than the cap
+        evictable = [filename for filename in self.images if filename in self.evictable]
+        for filename in evictable[:-1]:
+            if self.memory_used <= self.memory_cap:
+                break
+            image = self.images.pop(filename)
+            self.memory_used -= image.get_width() * image.get_height() * image.get_bytesize()
+
+#***********************************************************************
+#*                       HIGH SCORE STORE                              *
+#***********************************************************************
+class HighScoreStore:
+    """The high score table, shared by every game using the file and saved
+    off the game loop.
+
+    New scores change the table in memory straight away and are handed to
+    a writer thread.  Every entry gets an id of its own.  The writer holds
+    a lock file while it appends the new entries to a journal, reads the
+    table and journal back so scores saved by other games aren't lost,
+    writes the merged table to a temporary file and renames it over the
+    table, and empties the journal.  A crash never leaves a half written
+    table behind, and load() folds in any journal entries left by a game
+    that stopped before its table was saved.  Lines that can't be parsed
+    are skipped.
+    """
+
+    def __init__(self, filename, size=10):
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.lock_filename = filename + ".lock"
+        self.size = size
+        self.scores = None  # (name, score, id) entries, best first
+        self.lock = threading.Lock()  # guards scores
+        self.pending = queue.Queue()
+        self.writer = None
+
+    def load(self):
+        """Return the table, reading it and the journal on first use"""
+        if self.scores is None:
+            journal = self.read_journal()
+            scores = self.merge(self.read_table() + journal)
+            with self.lock:
+                self.scores = scores
+            if journal:
+                self.pending.put(None)  # compact the journal into the table
+                self.start_writer()
+        return self.table()
+
+    def add(self, name, score):
+        """Add a score and return the new table.  The disk is updated later"""
+        self.load()
+        # the files are comma separated, one entry per line
+        name = name.replace(",", " ").replace("\n", " ")
+        entry = (name, score, uuid.uuid4().hex)
+        with self.lock:
+            self.scores = self.merge(self.scores + [entry])
+        self.pending.put(entry)
+        self.start_writer()
+        return self.table()
+
+    def flush(self):
+        """Wait until every score added so far has been saved"""
+        if self.writer is not None:
+            self.pending.join()
+
+    def table(self):
+        with self.lock:
+            return [(name, score) for name, score, _ in self.scores]
+
+    def merge(self, entries):
+        """Return the best entries, counting each id once"""
+        unique = {entry[2]: entry for entry in entries}
+        return sorted(unique.values(), key=lambda entry: entry[1], reverse=True)[:self.size]
+
+    def read_table(self):
+        scores = []
+        try:
+            # a damaged byte spoils only its own line
+            with open(self.filename, "r", encoding="utf-8", errors="replace") as file:
+                for number, line in enumerate(file):
+                    line = line.strip()
+                    fields = line.split(",")
+                    if fields[0] == "#journal":
+                        continue  # written by older versions
+                    try:
+                        if len(fields) == 3:
+                            scores.append((fields[0], int(fields[1]), fields[2]))
+                        else:
+                            # older tables have no ids, so their lines are
+                            # numbered the same way by every game that reads them
+                            name, value = fields
+                            scores.append((name, int(value), f"line{number}"))
+                    except ValueError:
+                        if line:
+                            print(f"Skipping bad high score line {line!r}")
+        except FileNotFoundError:
+            print(f"High scores file '{self.filename}' not found. Starting fresh.")
+            scores = [("None", 0, f"line{number}") for number in range(self.size)]  # Default scores
+        return scores
+
+    def read_journal(self):
+        entries = []
+        try:
+            with open(self.journal_filename, "r", encoding="utf-8", errors="replace") as file:
+                for line in file:
+                    # the last line may have been cut short by a crash
+                    fields = line.strip().split(",")
+                    try:
+                        entries.append((fields[1], int(fields[2]), fields[0]))
+                    except (ValueError, IndexError):
+                        pass
+        except FileNotFoundError:
+            pass
+        return entries
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        """Hold the lock file, so only one game at a time changes the files"""
+        with open(self.lock_filename, "a+") as lock_file:
+            lock_file.seek(0)
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def start_writer(self):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop, daemon=True,
+                                           name="high scores")
+            self.writer.start()
+
+    def write_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            while not self.pending.empty():
+                batch.append(self.pending.get())
+            try:
+                self.write([entry for entry in batch if entry is not None])
+            except Exception as error:
+                # keep the writer alive, flush() waits on it at quit
+                print(f"Could not save high scores: {error}")
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+    def write(self, entries):
+        """Journal entries, then merge them into the table on disk"""
+        with self.file_lock():
+            with open(self.journal_filename, "a", encoding="utf-8") as journal:
+                for name, score, entry_id in entries:
+                    journal.write(f"{entry_id},{name},{score}\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+
+            # other games may have saved scores since this one read the table
+            scores = self.merge(self.read_table() + self.read_journal())
+            temp_filename = f"{self.filename}.{os.getpid()}.tmp"
+            with open(temp_filename, "w", encoding="utf-8") as file:
+                for name, score, entry_id in scores:
+                    file.write(f"{name},{score},{entry_id}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_filename, self.filename)
+
+            # every game journals and compacts under the lock, so the whole
+            # journal is in the table now
+            open(self.journal_filename, "w").close()
+
+        with self.lock:
+            self.scores = self.merge(self.scores + scores)
+
+#***********************************************************************
+#*                       MUSIC PLAYER                                  *
+#***********************************************************************
+class MusicPlayer:
+    """Plays the music tracks in random order, never the same one twice running.
+
+    While a track plays, the next one is picked and read into memory on a
+    worker thread, so starting it doesn't stall a frame on the disk.  Only
+    the file's bytes are held, still compressed, and the mixer decodes
+    them as it streams.  The playing track and the next can each take up
+    to prefetch_limit bytes; bigger tracks, or every track when the limit
+    is 0, are streamed from disk as before.  With no tracks play_next()
+    does nothing and with one track it repeats.  The player has its own
+    random number generator so music never changes a seeded game.
+    """
+
+    def __init__(self, filenames, prefetch_limit=16 * 1024 * 1024):
+        self.filenames = sorted(filenames)
+        self.prefetch_limit = prefetch_limit
+        self.rng = random.Random()
+        self.current = None
+        self.current_data = None  # the mixer streams from this while it plays
+        self.next_track = None
+        self.worker = None
+        if self.filenames:
+            self.worker = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="music")
+            self.prefetch()
+
+    def prefetch(self):
+        choices = [name for name in self.filenames if name != self.current]
+        self.next_track = self.worker.submit(self.read_track,
+                                             self.rng.choice(choices or self.filenames))
+
+    def read_track(self, filename):
+        """Return the filename and its contents, or None if it is too big to hold"""
+        if os.path.getsize(filename) > self.prefetch_limit:
+            return filename, None
+        with open(filename, "rb") as file:
+            return filename, io.BytesIO(file.read())
+
+    def play_next(self):
+        if self.next_track is None:
+            return
+        try:
+            filename, data = self.next_track.result()  # normally long finished
+            if data is None:
+                pygame.mixer.music.load(filename)
+            else:
+                pygame.mixer.music.load(data, os.path.splitext(filename)[1][1:])
+            pygame.mixer.music.play(0)
+            self.current, self.current_data = filename, data
+        except (OSError, pygame.error) as error:
+            print(f"Could not play music: {error}")
+        self.prefetch()
+
+def find_music(directory):
+    """Return the music files in directory, taking the OGG copy of any track
+    that is also there as a WAV"""
+    tracks = {}
+    for pattern in ("*.wav", "*.ogg"):
+        for filename in glob.glob(os.path.join(directory, pattern)):
+            tracks[os.path.splitext(filename)[0]] = filename
+    return list(tracks.values())
+
+#***********************************************************************
+#*                       INPUT RECORDING                               *
+#***********************************************************************
+class InputRecording:
+    """The random seed and the keys held on every simulation step of a game.
+
+    The simulation only depends on those, so they are enough to play the
+    game again exactly.  Each step is one byte of INPUT_* bits, and the
+    steps are stored zlib compressed after a header holding the seed, the
+    resolution the game was played at and its final score, which a replay
+    is checked against.
+    """
+    MAGIC = b"SVRC"
+    VERSION = 1
+    HEADER = struct.Struct("<4sBqHHiI")  # magic, version, seed, width, height, score, steps
+
+    def __init__(self, seed, width, height):
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.score = 0
+        self.inputs = bytearray()
+
+    @property
+    def resolution(self):
+        return "%dx%d" % (self.width, self.height)
+
+    def save(self, filename):
+        with open(filename, "wb") as file:
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.seed, self.width,
+                                        self.height, self.score, len(self.inputs)))
+            file.write(zlib.compress(bytes(self.inputs)))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as file:
+            data = file.read()
+        try:
+            magic, version, seed, width, height, score, steps = cls.HEADER.unpack_from(data)
+            inputs = zlib.decompress(data[cls.HEADER.size:])
+        except (struct.error, zlib.error):
+            raise ValueError(f"'{filename}' is not a Santavaders recording")
+        if magic != cls.MAGIC or version != cls.VERSION or len(inputs) != steps:
+            raise ValueError(f"'{filename}' is not a Santavaders recording")
+        recording = cls(seed, width, height)
+        recording.score = score
+        recording.inputs = bytearray(inputs)
+        return recording
 
 #***********************************************************************
 #*                       FUNCTIONS AREA                                *
 #***********************************************************************
-def play_next_song():
-    global current_song
-    
-    song = random.choice(song_list)
-    while song == current_song:
-        song = random.choice(song_list)
-    pygame.mixer.music.load(song)
-    pygame.mixer.music.play(0)
+def game_ticks():
+    """Return the game clock in milliseconds.
+
+    The game clock only moves when the simulation takes a fixed step, so
+    every timer in the game runs at the same speed however fast frames are
+    drawn, and a seeded headless run plays out the same way on any machine.
+    """
+    return sim_steps * SIM_STEP_MS
+
+def advance_game_clock():
+    """Move the game clock forward by one fixed simulation step"""
+    global sim_steps
+    sim_steps += 1
+
+def game_time():
+    """Return the game clock in seconds"""
+    return game_ticks() / 1000
 
 def play_sound(sound):
     """Play passed in sound object on new channel"""
@@ -50,99 +694,91 @@ def play_sound(sound):
         channel.set_volume(sound_volume)
 
 
+def get_mask(surface):
+    """Return the collision mask of surface from the mask registry.
+
+    The registry is filled once per resolution when the sprites are loaded,
+    so the game never builds a mask in the middle of a frame.
+    """
+    mask = surface_masks.get(surface)
+    if mask is None:
+        mask = pygame.mask.from_surface(surface)
+        surface_masks[surface] = mask
+    return mask
+
+def pack_shelves(sizes, width):
+    """Place rectangles of sizes on shelves width wide.
+
+    Tallest first, each goes on the first shelf with room for it.  Returns
+    the position of each, in the order of sizes, and the height used.
+    """
+    shelves = []  # [y, height, x of the free space]
+    positions = [None] * len(sizes)
+    height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[i]
+        for shelf in shelves:
+            if shelf[2] + w <= width and h <= shelf[1]:
+                break
+        else:
+            shelf = [height, h, 0]
+            shelves.append(shelf)
+            height += h
+        positions[i] = (shelf[2], shelf[0])
+        shelf[2] += w
+    return positions, height
+
+def has_hard_edges(image):
+    """Return True if every pixel of image is either fully clear or fully opaque"""
+    opaque = pygame.mask.from_surface(image, 254).count()
+    if opaque != pygame.mask.from_surface(image, 0).count():
+        return False
+    # the colorkey must not also be the colour of a visible pixel
+    return pygame.mask.from_threshold(image, COLORKEY + (255,), (1, 1, 1, 1)).count() == 0
+
 def scale_image_by(image, scale_factor_x, scale_factor_y):
     height = image.get_height() * scale_factor_y
     width = image.get_width() * scale_factor_x
     return pygame.transform.scale(image, (width, height))
     
-def load_image(filename, scale_factor_x, scale_factor_y):
-    image = pygame.image.load(filename).convert_alpha()
-    return scale_image_by(image, scale_factor_x, scale_factor_y)
-    
-def display_pause_screen():
-    """Render the pause screen and wait for user input."""
-    global game_state
-    pause_text = font.render("PAUSED", True, (255, 0, 0))  # Red text
-    pause_shadow = font.render("PAUSED", True, (0, 128, 0))  # Green shadow
-    instructions_text = font.render("Press P to Resume or Q to Quit", True, (255, 0, 0))
-    instructions_shadow = font.render("Press P to Resume or Q to Quit", True, (0, 128, 0))
-
-    # Blit the shadow (slightly offset) and the text
-    screen.blit(pause_shadow, (SCREEN_WIDTH // 2 - pause_text.get_width() // 2 + 5, SCREEN_HEIGHT // 3 + 5))
-    screen.blit(pause_text, (SCREEN_WIDTH // 2 - pause_text.get_width() // 2, SCREEN_HEIGHT // 3))
-
-    screen.blit(instructions_shadow, (SCREEN_WIDTH // 2 - instructions_text.get_width() // 2 + 5, SCREEN_HEIGHT // 2 + 5))
-    screen.blit(instructions_text, (SCREEN_WIDTH // 2 - instructions_text.get_width() // 2, SCREEN_HEIGHT // 2))
+def decode_image(filename, scale_factor_x, scale_factor_y):
+    """Load and scale an image without converting it for the display.
 
-    pygame.display.flip()
+    This is safe on a worker thread, where pygame decodes and scales with
+    the GIL released.
+    """
+    return scale_image_by(pygame.image.load(filename), scale_factor_x, scale_factor_y)
 
-    # Wait for player input to resume or quit
-    waiting = True
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                game_data["game_state"] = GAME_STATE_QUIT
-                waiting = False
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_p:  # Resume game
-                    game_data["game_state"] = GAME_STATE_RUNNING
-                    waiting = False
-                if event.key == pygame.K_q:  # Quit game
-                    game_data["game_state"] = GAME_STATE_QUIT
-                    waiting = False
-        
-def display_title_screen():
-    global game_state
+def load_image(filename, scale_factor_x, scale_factor_y):
+    return decode_image(filename, scale_factor_x, scale_factor_y).convert_alpha()
+
+def wait_for_loading(jobs):
+    """Wait for the startup jobs, drawing a progress bar on the title screen"""
+    pending = set(jobs)
+    while pending:
+        done, pending = concurrent.futures.wait(pending, timeout=1/30)
+        if not HEADLESS:
+            draw_loading_progress(1 - len(pending) / len(jobs))
+            pygame.event.pump()  # keep the window responsive
+
+def draw_loading_progress(fraction):
+    bar = pygame.Rect(0, 0, SCREEN_WIDTH // 2, max(4, int(30*SCALE_FACTOR)))
+    bar.midbottom = (SCREEN_WIDTH // 2, SCREEN_HEIGHT - bar.height)
+    pygame.draw.rect(screen, (0, 128, 0), bar)
+    pygame.draw.rect(screen, (255, 0, 0), (bar.x, bar.y, int(bar.width * fraction), bar.height))
+    present([bar])
     
-    pygame.time.wait(1000) #debounce the space bar and wait for sound system
-    #stop all sounds and music during title screen
-    pygame.mixer.stop()
-    pygame.mixer.music.pause()
-    screen.blit(title_screen_image, (0, 0))
-    pygame.display.flip()
-    while game_data["game_state"] == GAME_STATE_TITLE:
-        keys = pygame.key.get_pressed()
-        for event in pygame.event.get():
-            if event == pygame.QUIT:
-                game_data["game_state"] = GAME_STATE_QUIT
-        if keys[pygame.K_SPACE]:
-            game_data["game_state"] = GAME_STATE_RUNNING
-            reset_game(True)
-        if keys[pygame.K_ESCAPE]:
-            game_data["game_state"] = GAME_STATE_QUIT
-
 def reset_game(load_next_level):
-    global game_data
+    global game_data, sim_steps
     # Reset the game data dictionary back to original
     game_data = dict(default_game_data)
+    sim_steps = 0  # every game starts at game time 0
     if load_next_level:
         start_next_level()
 
 # ***********************************************************************
 # *                       HIGH SCORES MANAGEMENT                       *
 # ***********************************************************************
-def load_high_scores():
-    high_scores = []
-    try:
-        with open(HIGH_SCORES_FILE, "r") as file:
-            for line in file:
-                name, score = line.strip().split(",")
-                high_scores.append((name, int(score)))
-    except FileNotFoundError:
-        print(f"High scores file '{HIGH_SCORES_FILE}' not found. Starting fresh.")
-        high_scores = [("None", 0) for _ in range(10)]  # Default scores
-    return high_scores
-
-def save_high_scores(high_scores):
-    with open(HIGH_SCORES_FILE, "w") as file:
-        for name, score in high_scores:
-            file.write(f"{name},{score}\n")
-
-def update_high_scores(player_name, player_score, high_scores):
-    high_scores.append((player_name, player_score))
-    high_scores = sorted(high_scores, key=lambda x: x[1], reverse=True)[:10]
-    return high_scores
-
 def display_high_scores(high_scores, player_name=None, player_score=None):
     y_start = SCREEN_HEIGHT // 14+50*(SCALE_FACTOR)  # Starting y-coordinate
       # Get height of the font and add padding
@@ -160,204 +796,278 @@ def display_high_scores(high_scores, player_name=None, player_score=None):
         screen.blit(score_text, (SCREEN_WIDTH // 2 - score_text.get_width() // 2, y_start + i * line_height))
 
 # ***********************************************************************
-# *                     GAME OVER SCREEN                     *
+# *                       HUD TEXT                                      *
 # ***********************************************************************
+def make_hud_atlas(color):
+    """Pre-render the HUD labels and digits in one color at the final .75 scale"""
+    atlas = {}
+    for text in HUD_LABELS + tuple(HUD_GLYPHS):
+        atlas[text] = scale_image_by(font.render(text, True, color), .75, .75)
+    return atlas
+
+def compose_hud_text(label, value):
+    """Build a label+value surface with its drop shadow from the glyph atlas"""
+    pieces = [label] + list(str(value))
+    text_glyphs = [hud_atlas["text"][piece] for piece in pieces]
+    shadow_glyphs = [hud_atlas["shadow"][piece] for piece in pieces]
+    width = sum(glyph.get_width() for glyph in text_glyphs) + HUD_SHADOW_OFFSET
+    height = max(glyph.get_height() for glyph in text_glyphs) + HUD_SHADOW_OFFSET
+    surface = pygame.Surface((width, height), pygame.SRCALPHA)
+
+    # draw the whole shadow first so it never covers the main text
+    x = 0
+    for glyph in shadow_glyphs:
+        surface.blit(glyph, (x + HUD_SHADOW_OFFSET, HUD_SHADOW_OFFSET))
+        x += glyph.get_width()
+    x = 0
+    for glyph in text_glyphs:
+        surface.blit(glyph, (x, 0))
+        x += glyph.get_width()
+    return surface
+
+def get_hud_text(label, value):
+    """Return the HUD surface for label, recomposing it only if value changed"""
+    cached = hud_text_cache.get(label)
+    if cached is None or cached[0] != value:
+        cached = (value, compose_hud_text(label, value))
+        hud_text_cache[label] = cached
+    return cached[1]
 
-def game_over():
-    global game_data
-    pygame.mixer.stop()
-    player_name = getpass.getuser()  # Retrieve player username
-    high_scores = load_high_scores()  
+# ***********************************************************************
+# *                     GAME OVER SCREEN                     *
+# ***********************************************************************
 
-    # Update the high scores with the player's score
-    player_score = game_data["player_score"]
-    updated_high_scores = update_high_scores(player_name, player_score, high_scores)
-    save_high_scores(updated_high_scores)  # Save the updated high scores
+def update_game_over_snow():
+    """Move the snowflakes behind the high score table"""
+    snow.update()
 
-    # Initial display of the last game scene with GAME OVER text
-    large_font = pygame.font.Font(font_path, int(200*SCALE_FACTOR))  # Set the font size to double the original
-    game_over_text = large_font.render("GAME OVER", True, (255, 0, 0))  # Red text
-    game_over_shadow = large_font.render("GAME OVER", True, (0, 255, 0))  # Green shadow
-    text_rect = game_over_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-    shadow_rect = game_over_shadow.get_rect(center=(SCREEN_WIDTH // 2 + 10, SCREEN_HEIGHT // 2 + 10))  # Slight offset for shadow
+def draw_game_over_screen(high_scores, player_name, player_score):
+    """Draw the snowfall, GAME OVER banner and high score table"""
+    screen.fill((0, 0, 0))  # Clear the screen
+    snow.draw(screen)
 
-    end_game_time = pygame.time.get_ticks() + 4000  # 4 seconds display
-
-    while pygame.time.get_ticks() < end_game_time:
-        screen.blit(game_over_shadow, shadow_rect)  # First the shadow
-        screen.blit(game_over_text, text_rect)  # Then the text
-        pygame.display.flip()
-        for event in pygame.event.get():
-            if event.type is pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-    # After 4 seconds, proceed to standard game over screen
-   
-    while game_data["game_state"] == GAME_STATE_GAME_OVER:
-        screen.fill((0, 0, 0))  # Clear the screen
-        for snowflake in snowflakes:
-            snowflake["y"] += snowflake["speed"]*SCALE_FACTOR
-            if snowflake["y"] > SCREEN_HEIGHT:
-                snowflake["y"] = 0
-                snowflake["x"] = random.randint(0, SCREEN_WIDTH)
-            pygame.draw.circle(screen, (255, 255, 255), (int(snowflake["x"]), int(snowflake["y"])), snowflake["size"])
-
-        # Redisplay game over message and other info with shadow\
-        game_over_shadow = font.render("GAME OVER", True, (0, 255, 0))  # Green shadow
-        game_over_text = font.render("GAME OVER", True, (255, 0, 0))  # Red text
-        screen.blit(game_over_shadow, (SCREEN_WIDTH // 2 - game_over_shadow.get_width() // 2 + 5, 10))  # Shadow offset
-        screen.blit(game_over_text, (SCREEN_WIDTH // 2 - game_over_text.get_width() // 2, 5))  # Main text
-        
-        display_high_scores(updated_high_scores, player_name, player_score)
-        
-        instructions_text = font.render("Press Q to Quit or SPACE to Restart", True, (255, 255, 255))
-        y_offset = instructions_text.get_height()
-        screen.blit(instructions_text, (SCREEN_WIDTH // 2 - instructions_text.get_width() // 2, SCREEN_HEIGHT - y_offset))
-        
-        pygame.display.flip()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                game_data["game_state"] = GAME_STATE_QUIT
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_q or event.key == pygame.K_ESCAPE:
-                    game_data["game_state"] = GAME_STATE_QUIT
-                if event.key == pygame.K_SPACE:
-                    game_data["game_state"] = GAME_STATE_TITLE
-                    pygame.time.wait(500) #debounce the space key
-        clock.tick(60)
-
-def draw_scene():
+    # Redisplay game over message and other info with shadow\
+    game_over_shadow = font.render("GAME OVER", True, (0, 255, 0))  # Green shadow
+    game_over_text = font.render("GAME OVER", True, (255, 0, 0))  # Red text
+    screen.blit(game_over_shadow, (SCREEN_WIDTH // 2 - game_over_shadow.get_width() // 2 + 5, 10))  # Shadow offset
+    screen.blit(game_over_text, (SCREEN_WIDTH // 2 - game_over_text.get_width() // 2, 5))  # Main text
+    
+    display_high_scores(high_scores, player_name, player_score)
+    
+    instructions_text = font.render("Press Q to Quit or SPACE to Restart", True, (255, 255, 255))
+    y_offset = instructions_text.get_height()
+    screen.blit(instructions_text, (SCREEN_WIDTH // 2 - instructions_text.get_width() // 2, SCREEN_HEIGHT - y_offset))
+
+def save_previous_positions():
+    """Remember where the moving objects are before a simulation step"""
+    previous_positions["player"] = player_rect.topleft
+    previous_positions["star"] = star_rect.topleft if game_data["star_active"] else None
+    previous_positions["bag"] = bag_rect.topleft if game_data["guided_bag_active"] else None
+    previous_positions["sleigh"] = santa_sleigh_rect.topleft if game_data["santa_sleigh_active"] else None
+    previous_positions["invaders"] = (invaders_pos[0], invaders_pos[1])
+    for present in present_pool:
+        present.prev_x = present.rect.x
+        present.prev_y = present.rect.y
+
+def interpolated(previous, current, alpha):
+    """Return the position alpha of the way from previous to current.
+
+    Objects that just appeared, or that jumped further than any of them can
+    move in one step, are drawn where they are now.
+    """
+    if previous is None or alpha >= 1:
+        return current
+    dx = current[0] - previous[0]
+    dy = current[1] - previous[1]
+    if abs(dx) > INTERPOLATION_SNAP_DISTANCE or abs(dy) > INTERPOLATION_SNAP_DISTANCE:
+        return current
+    return (previous[0] + dx*alpha, previous[1] + dy*alpha)
+
+def draw_scene(alpha=1.0):
+    """Draw the game.  alpha is how far the display is between the last two
+    simulation steps, 1.0 draws everything where it is now"""
     global invaders, star_rect, santa_sleigh_rect, bag_rect
-    global player_rect, present_list, fireplaces, game_data 
-    # Fill the background with background
-    screen.fill((25, 25, 64))
+    global player_rect, fireplaces, game_data 
+    # Clear the screen.  In dirty rectangle mode only the areas drawn last
+    # frame are restored from the cached background
+    if DIRTY_RECT_MODE and not render_data["full_redraw"]:
+        for rect in render_data["previous_rects"]:
+            screen.blit(background, rect, rect)
+    else:
+        screen.blit(background, (0, 0))
+    # every rectangle drawn this frame is kept for the display update
+    drawn = render_data["drawn_rects"] = []
 
 # Draw snowflakes
-    for snowflake in snowflakes:
-        pygame.draw.circle(screen, (255, 255, 255), (int(snowflake["x"]), int(snowflake["y"])), snowflake["size"])
+    if DIRTY_RECT_MODE:
+        drawn.extend(snow.draw(screen, return_rects=True))
+    else:
+        snow.draw(screen)
 
-    #draw the player
-    screen.blit(current_player_image, (player_rect.x, player_rect.y))
+    # Everything else is collected into a display list of (surface, position)
+    # pairs per layer, and each layer is drawn with a single blits() call.
+    # The layers are drawn in the order they are listed here
+    sprite_layer = [(current_player_image, 
+                     interpolated(previous_positions.get("player"), player_rect.topleft, alpha))]
     
     #draw the star missile if it is active
     if game_data["star_active"]:
-        screen.blit(star_image, star_rect)
+        sprite_layer.append((star_image, interpolated(previous_positions.get("star"), star_rect.topleft, alpha)))
         
     #draw santa sleigh at the top if active
     if game_data["santa_sleigh_active"]:
-        screen.blit(santa_sleigh_image, santa_sleigh_rect)
+        sprite_layer.append((santa_sleigh_image, 
+                             interpolated(previous_positions.get("sleigh"), santa_sleigh_rect.topleft, alpha)))
     
     #draw santas guided bag missile if active
     if game_data["guided_bag_active"]:
-        screen.blit(bag_image, bag_rect)
+        sprite_layer.append((bag_image, interpolated(previous_positions.get("bag"), bag_rect.topleft, alpha)))
         
-    #draw the invaders and exploding invaders
-    for row in range(5):
-        for col in range(11):
-            if invaders[row][col]["active"]:
-                x = invaders_pos[0] + (col*invader_width) + (invader_width//2)*col 
-                y = invaders_pos[1] + (row*invader_height ) + (invader_height//2) * row
-                invaders[row][col]["rect"] = screen.blit(invader_image, [x, y] )
-            if invaders[row][col]["exploding"] and time.time() - invaders[row][col]["explode_time"]> EXPLOSION_FRAME_DURATION:
-                frame = invaders[row][col]["explode_frame"]
-                x_pos = invaders_pos[0] + (col*invader_width) + (invader_width//2)*col 
-                y_pos = invaders_pos[1] + (row*invader_height ) + (invader_height//2) * row
-                screen.blit(explosion_graphics[frame], [x_pos, y_pos] )
-                frame = frame + 1
-                if frame == len(explosion_graphics):
-                    invaders[row][col]["exploding"] = False
-                invaders[row][col]["explode_frame"] = frame
-                invaders[row][col]["explode_time"] = time.time()
+    #draw the invaders and exploding invaders.  The positions are worked out
+    #from the formation origin and the grid pitch in the same pass
+    origin_x, origin_y = interpolated(previous_positions.get("invaders"), invaders_pos, alpha)
+    origin_x, origin_y = int(origin_x), int(origin_y)
+    pitch_x = invader_width + invader_width//2
+    pitch_y = invader_height + invader_height//2
+    invader_layer = [(invader_image, (origin_x + col*pitch_x, origin_y + row*pitch_y))
+                     for row, col in invaders.active_cells()]
+    now = game_time()
+    for index in range(len(invaders.exploding)):
+        if invaders.exploding[index] and now - invaders.explode_time[index] > EXPLOSION_FRAME_DURATION:
+            frame = invaders.explode_frame[index]
+            row, col = divmod(index, invaders.cols)
+            invader_layer.append((explosion_graphics[frame], (origin_x + col*pitch_x, origin_y + row*pitch_y)))
+            frame = frame + 1
+            if frame == len(explosion_graphics):
+                invaders.exploding[index] = 0
+            invaders.explode_frame[index] = frame
+            invaders.explode_time[index] = now
              
     #draw presents if there are active presents in the list
-    if present_list:
-        for present in present_list:
-            screen.blit(present_image, present )
-
+    present_layer = [(present_image, interpolated((present.prev_x, present.prev_y), present.rect.topleft, alpha))
+                     for present in present_pool]
 
-    #draw fireplaces using the eroded masks
+    #draw fireplaces using the cached eroded surfaces
+    fireplace_layer = []
     if game_data["fireplaces_active"]:
-        for fireplace in fireplaces:
-            if fireplace["active"]:
-            # Create a surface where the mask is rendered
-                mask_surface = fireplace["mask"].to_surface(unsetcolor=(0, 0, 0, 0), setcolor=(255, 255, 255, 255))
-                # Create a new surface for the filtered fireplace
-                filtered_surface = pygame.Surface(fireplace["surface"].get_size(), pygame.SRCALPHA)
-                filtered_surface.blit(fireplace_image, (0, 0))  # Copy original fireplace image
-                filtered_surface.blit(mask_surface, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)  # Apply the mask
-                # Blit the filtered surface to the screen
-                screen.blit(filtered_surface, (fireplace["x"], fireplace["y"]))
+        fireplace_layer = [(fireplace["surface"], (fireplace["x"], fireplace["y"]))
+                           for fireplace in fireplaces if fireplace["active"]]
 
     # draw explosions if there are any in the list
-    if explosion_list:
-        for explosion in explosion_list:
-            image_num = explosion["frame"]
-            image = explosion_graphics[image_num]
-            rect = explosion["rect"]
-            screen.blit(image, rect)
-            
+    explosion_layer = [(explosion_graphics[explosion.frame], explosion.rect)
+                       for explosion in explosion_pool]
         
-    # Render the score text with a shadow effect
-    player_score = game_data["player_score"]
-    score_text = font.render(f"Score: {player_score}", True, (255, 0, 0))  # Red text
-    shadow_text = font.render(f"Score: {player_score}", True, (0, 128, 0))  # Green shadow
-    score_text = scale_image_by(score_text, .75, .75)
-    shadow_text = scale_image_by(shadow_text, .75, .75)
-    # Calculate text width and positions
-    text_width = score_text.get_width()
-    x_position = SCREEN_WIDTH - text_width - (20*SCALE_FACTOR)
-    y_position = 50 * SCALE_FACTOR
-    # Draw shadow slightly offset
-    screen.blit(shadow_text, (x_position + 5, y_position + 5))
-    # Draw the main text
-    screen.blit(score_text, (x_position, y_position))
-
-    # Render the level text with a shadow effect
-    current_level = game_data["current_level"]+1
-    level_text = font.render(f"Level: {current_level}", True, (255, 0, 0))  # White text
-    shadow_text = font.render(f"Level: {current_level}", True, (0, 128, 0))  # Green shadow
-    level_text = scale_image_by(level_text, .75, .75)
-    shadow_text = scale_image_by(shadow_text, .75, .75) 
-    # Calculate text width and positions of the level text
-    text_width = level_text.get_width()
-    x_position = 20 * SCALE_FACTOR
-    y_position = 50 * SCALE_FACTOR
-    # Draw shadow slightly offset
-    screen.blit(shadow_text, (x_position + 5, y_position + 5))
-    # Draw the main text
-    screen.blit(level_text, (x_position, y_position))
+    # Draw the score and level text from the cached HUD surfaces.  These
+    # are only recomposed from the glyph atlas when the value changes
+    score_text = get_hud_text("Score: ", game_data["player_score"])
+    text_width = score_text.get_width() - HUD_SHADOW_OFFSET
+    level_text = get_hud_text("Level: ", game_data["current_level"]+1)
+    hud_layer = [(score_text, (SCREEN_WIDTH - text_width - (20*SCALE_FACTOR), 50 * SCALE_FACTOR)),
+                 (level_text, (20 * SCALE_FACTOR, 50 * SCALE_FACTOR))]
+
+    for layer in (sprite_layer, invader_layer, present_layer, fireplace_layer,
+                  explosion_layer, hud_layer):
+        if DIRTY_RECT_MODE:
+            drawn.extend(screen.blits(layer))
+        else:
+            screen.blits(layer, doreturn=False)
     
-    #draw FPSscreen.blit(playerimage, playerpos)
+    #draw the profiling overlay
     if game_data["show_fps"]:
-        fps = str(int(clock.get_fps()))
-        fps_text = font.render(fps, 1, pygame.Color("coral"))
-        screen.blit(fps_text, (10,SCREEN_HEIGHT-fps_text.get_height()))
+        drawn.append(draw_profile_overlay())
         
+def update_display():
+    """Show the frame drawn by draw_scene() on the screen"""
+    if DIRTY_RECT_MODE and not render_data["full_redraw"]:
+        # push the areas drawn over last frame, which now show background
+        # again, along with the areas drawn this frame
+        present(render_data["previous_rects"] + render_data["drawn_rects"])
+    else:
+        present()
+    render_data["previous_rects"] = render_data["drawn_rects"]
+    render_data["full_redraw"] = False
+
+def request_full_redraw():
+    """Redraw the whole screen next frame, e.g. after another screen was shown"""
+    render_data["full_redraw"] = True
+
+def present(rects=None):
+    """Show what has been drawn on screen in the window.
+
+    rects limits the update to those areas.  When the game is drawn smaller
+    than the window, the whole frame is scaled up to the window first
+    unless SDL does the scaling.
+    """
+    if not UPSCALING:
+        if rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+        return
+    upscaler = render_data["upscaler"]
+    if upscaler == "scaled":
+        # the window surface is the size of screen and SDL scales it up
+        if rects is None:
+            window.blit(screen, (0, 0))
+        else:
+            for rect in rects:
+                window.blit(screen, rect, rect)
+    elif upscaler == "smoothscale":
+        pygame.transform.smoothscale(screen, window.get_size(), window)
+    else:
+        pygame.transform.scale(screen, window.get_size(), window)
+    pygame.display.flip()
+
+def open_window():
+    """Open the window for the current upscaler and return its surface"""
+    # vsync needs SDL's renderer, which pygame only uses with the SCALED flag
+    vsync = options.vsync and not HEADLESS
+    if UPSCALING and render_data["upscaler"] == "scaled":
+        # SDL's dummy driver has no renderer, so headless there's nothing to scale
+        if HEADLESS:
+            return pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        surface = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SCALED, vsync=vsync)
+        # SDL sizes the window and scales the frame by whole multiples only.
+        # Without a logical size its renderer stretches the frame over the
+        # whole window, which has the same shape, so it can be the window size
+        sdl_window = pygame._sdl2.video.Window.from_display_module()
+        sdl_window.size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+        pygame._sdl2.video.Renderer.from_window(sdl_window).logical_size = (0, 0)
+        return surface
+    if vsync:
+        return pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.SCALED, vsync=1)
+    return pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+
+def set_upscaler(upscaler):
+    """Change how the game is scaled up to the window, reopening the
+    window if SDL's scaling is switched on or off"""
+    global window
+    reopen = (upscaler == "scaled") != (render_data["upscaler"] == "scaled")
+    render_data["upscaler"] = upscaler
+    if reopen:
+        window = open_window()
+    request_full_redraw()
+
 def update():
-    global star_rect, current_player_image, santa_sleigh_rect, snowflakes
-    global present_list, game_data, explosion_list
-    global current_player_mask, invaders
+    global star_rect, current_player_image, santa_sleigh_rect
+    global game_data, current_player_mask, invaders
    
     current_level = game_data["current_level"]
 
     #if santas sleigh is not active, check if it appears
     if not game_data["santa_sleigh_active"]:
-        if pygame.time.get_ticks() - game_data["sleigh_time"] > 11000:
+        if game_ticks() - game_data["sleigh_time"] > 11000:
             if random.randint(0,100) < 2:
                 game_data["santa_sleigh_active"] = True
-                x = -(santa_sleigh_image.get_width())
-                y = 20*SCALE_FACTOR
-                width = santa_sleigh_image.get_width()
-                height = santa_sleigh_image.get_height()
-                santa_sleigh_rect = pygame.Rect(x,y, width, height)
+                santa_sleigh_rect.x = -(santa_sleigh_image.get_width())
+                santa_sleigh_rect.y = 20*SCALE_FACTOR
                 play_sound(santa_sleigh_sound)
     else: #if santa sleigh is on the screen, update it and check bounds
         santa_sleigh_rect.x += level_data[current_level]["santa_sleigh_speed"]*SCALE_FACTOR
         if santa_sleigh_rect.x > SCREEN_WIDTH:
             game_data["santa_sleigh_active"] = False
             santa_sleigh_sound.stop()
-            game_data["sleigh_time"] = pygame.time.get_ticks()
+            game_data["sleigh_time"] = game_ticks()
 
     #update the direction and position of the guided bag/missile
     if game_data["guided_bag_active"]:
@@ -388,22 +1098,26 @@ def update():
         if star_rect.y <= 0: #check bounds
             game_data["star_active"] = False
             current_player_image = player_image_star
-            current_playher_mask = pygame.mask.from_surface(player_image_star)
+            current_player_mask = get_mask(player_image_star)
     
-    #update presents 
-    present_list = [present for present in present_list if present.y <= SCREEN_HEIGHT]
-    for present in present_list:
-        present.y += level_data[current_level]["present_speed"]*SCALE_FACTOR
-
-    #update the explosions in the explosion list
-    for i in range(len(explosion_list) - 1, -1, -1):  # iterate in reverse using index
-        explosion = explosion_list[i]
-        if time.time() - explosion["time"] > EXPLOSION_FRAME_DURATION:
-            explosion["frame"] += 1
-            if explosion["frame"] == len(explosion_graphics):
-                del explosion_list[i]  # delete by index
+    #update presents, dropping the ones that fell off the screen last frame
+    for present in present_pool:
+        if present.rect.y > SCREEN_HEIGHT:
+            present.active = False
+    present_pool.compact()
+    for present in present_pool:
+        present.rect.y += level_data[current_level]["present_speed"]*SCALE_FACTOR
+
+    #update the explosions in the explosion pool
+    now = game_time()
+    for explosion in explosion_pool:
+        if now - explosion.time > EXPLOSION_FRAME_DURATION:
+            explosion.frame += 1
+            if explosion.frame == len(explosion_graphics):
+                explosion.active = False
             else:
-                explosion["time"] = time.time()
+                explosion.time = now
+    explosion_pool.compact()
       
     #deativate fireplaces that receive too much damage
     for fireplace in fireplaces:
@@ -411,28 +1125,21 @@ def update():
             fireplace["active"] = False
             
     # Generate a random Santa present shot
-    active_invaders = [(row, col) for row in range(5) for col in range(11) if invaders[row][col]["active"]]
-    if active_invaders and random.randint(0, 101) < level_data[current_level]["invader_shot_chance"]:
-        row, col = random.choice(active_invaders)
-        x = invaders[row][col]["rect"].centerx
-        y = invaders[row][col]["rect"].centery
-        width = present_image.get_width()
-        height = present_image.get_height()
-        rect = pygame.Rect(x, y, width, height)
-        play_sound(santa_shoot_sound)
-        present_list.append(rect)
+    if invaders.alive and random.randint(0, 101) < level_data[current_level]["invader_shot_chance"]:
+        row, col = invaders.nth_active(random.randrange(invaders.alive))
+        x, y = invader_position(row, col)
+        # a full pool means the screen is already full of presents
+        if present_pool.spawn(x + invader_width // 2, y + invader_height // 2) is not None:
+            play_sound(santa_shoot_sound)
     
     # invader movement limits and reverse direction if necessary
+    # only the outermost alive columns can touch the sides of the screen
     reverse_direction = False
-    for row in range(len(invaders)):
-        for col in range(len(invaders[row])):
-            if invaders[row][col]["active"]:  # Check if invader is active
-                invader_rect = invaders[row][col]["rect"] #get the rectangle at that position
-                if invader_rect.x <= 0 or invader_rect.x + invader_width >= SCREEN_WIDTH:
-                    reverse_direction = True
-                    break
-        if reverse_direction:
-            break
+    if invaders.alive:
+        left_x = invader_position(0, invaders.leftmost_col)[0]
+        right_x = invader_position(0, invaders.rightmost_col)[0]
+        if left_x <= 0 or right_x + invader_width >= SCREEN_WIDTH:
+            reverse_direction = True
 
     if reverse_direction:
         game_data["invaders_dir"] *= -1  # Reverse direction
@@ -444,53 +1151,105 @@ def update():
     invaders_pos[0] += (current_speed+speed_add) * game_data["invaders_dir"]*SCALE_FACTOR
         
     # Update snowflakes
-    for snowflake in snowflakes:
-        snowflake["y"] += snowflake["speed"]*SCALE_FACTOR  # Move snowflake down
-        if snowflake["y"] > SCREEN_HEIGHT:  # If it goes off-screen
-            snowflake["y"] = 0  # Reset to the top
-            snowflake["x"] = random.randint(0, SCREEN_WIDTH)  # Random x position
-            snowflake["size"] = random.randint(2, 5)  # Random size
-            snowflake["speed"] = random.uniform(1, 3)  # Random speed
+    snow.update()
             
     # Check for lowest alien reaching fireplace or player Y-coordinate
-    for row in range(4, -1, -1):  # Iterate rows in reverse (4 to 0)
-        for col in range(11):
-            if invaders[row][col]["active"]:  # Check if the alien is active
-                alien_x = invaders_pos[0] + (col * invader_width) + (invader_width // 2) * col
-                alien_y = invaders_pos[1] + (row * invader_height) + (invader_height // 2) * row
-                alien_bottom = alien_y + invader_height
-
-                if alien_bottom >= playerpos[1]:  # Game Over Condition
-                    game_data["game_state"] = GAME_STATE_GAME_OVER
-                    return  # Exit immediately
-
-                if game_data["fireplaces_active"] and alien_bottom >= fireplace_y:  # Fireplace Condition
-                    game_data["fireplaces_active"] = False
-                    return  # Exit immediately after deactivating fireplaces
-    
-def erode_fireplace(fireplace, center, radius):
+    if invaders.alive:
+        alien_y = invader_position(invaders.lowest_row, 0)[1]
+        alien_bottom = alien_y + invader_height
 
-    # Convert world coordinates to local mask coordinates
-    local_center_x = center[0] - fireplace["x"]
-    local_center_y = center[1] - fireplace["y"]
+        if alien_bottom >= playerpos[1]:  # Game Over Condition
+            game_data["game_state"] = GAME_STATE_GAME_OVER
+            return  # Exit immediately
 
-    # Iterate through the mask pixels within the erosion radius
+        if game_data["fireplaces_active"] and alien_bottom >= fireplace_y:  # Fireplace Condition
+            game_data["fireplaces_active"] = False
+            return  # Exit immediately after deactivating fireplaces
+    
+def make_circle_brush(radius):
+    """Return a mask with every pixel inside radius of the center set"""
+    brush = pygame.mask.Mask((radius*2 + 1, radius*2 + 1))
     for y in range(-radius, radius + 1):
         for x in range(-radius, radius + 1):
             if x ** 2 + y ** 2 <= radius ** 2:  # Check if the point is within the circle
-                mask_x = local_center_x + x
-                mask_y = local_center_y + y
-                if 0 <= mask_x < fireplace["mask"].get_size()[0] and 0 <= mask_y < fireplace["mask"].get_size()[1]:
-                    fireplace["mask"].set_at((mask_x, mask_y), 0)  # Turn the bit off
+                brush.set_at((x + radius, y + radius), 1)
+    return brush
+
+def make_jagged_brush(radius):
+    """Return a crater shaped mask whose edge radius varies with the angle"""
+    brush = pygame.mask.Mask((radius*2 + 1, radius*2 + 1))
+    # a fixed seed keeps the crater the same for a given radius and leaves
+    # the game's random number sequence alone
+    rng = random.Random(radius)
+    edges = [rng.uniform(.7, 1.0) * radius for _ in range(16)]
+    for y in range(-radius, radius + 1):
+        for x in range(-radius, radius + 1):
+            angle = math.atan2(y, x) % (2 * math.pi)
+            edge = edges[int(angle / (2 * math.pi) * len(edges)) % len(edges)]
+            if x ** 2 + y ** 2 <= edge ** 2:
+                brush.set_at((x + radius, y + radius), 1)
+    return brush
+
+def get_erosion_brush(radius):
+    """Return the cached erosion brush of the current shape for radius"""
+    key = (EROSION_BRUSH_SHAPE, radius)
+    brush = erosion_brushes.get(key)
+    if brush is None:
+        brush = EROSION_BRUSH_MAKERS[EROSION_BRUSH_SHAPE](radius)
+        erosion_brushes[key] = brush
+    return brush
 
+def erode_fireplace(fireplace, center, radius):
+    brush = get_erosion_brush(radius)
+    brush_width, brush_height = brush.get_size()
+
+    # Convert world coordinates to the local mask coordinates of the
+    # upper left of the brush
+    local_x = int(center[0] - fireplace["x"]) - brush_width // 2
+    local_y = int(center[1] - fireplace["y"]) - brush_height // 2
+
+    if fireplace["shared"]:
+        fireplace["mask"] = fireplace["mask"].copy()
+        fireplace["surface"] = fireplace["surface"].copy()
+        fireplace["shared"] = False
+
+    # clear every bit under the brush in one call.  erase clips to the mask
+    fireplace["mask"].erase(brush, (local_x, local_y))
+
+    # only the area under the brush needs to be redrawn in the cached surface
+    redraw_fireplace(fireplace, pygame.Rect(local_x, local_y, brush_width, brush_height))
+
+def redraw_fireplace(fireplace, area):
+    """Apply the fireplace mask to its cached surface inside area"""
+    area = area.clip(fireplace["surface"].get_rect())
+    if not area:
+        return
+    # Erosion only ever clears mask bits, so multiplying the cached surface
+    # by the current mask gives the same result as rebuilding it from the
+    # original fireplace image
+    mask_surface = pygame.Surface(area.size, pygame.SRCALPHA)
+    fireplace["mask"].to_surface(mask_surface, setcolor=(255, 255, 255, 255), 
+                                 unsetcolor=(0, 0, 0, 0), dest=(-area.x, -area.y))
+    fireplace["surface"].blit(mask_surface, area.topleft, special_flags=pygame.BLEND_RGBA_MULT)
+
+def make_fireplace_template():
+    """Return the pristine fireplace mask and the image with it applied.
+
+    This is built once per resolution and copied only when a fireplace is
+    first hit, so starting a level costs no copying at all.
+    """
+    template = {"mask": get_mask(fireplace_image), "surface": fireplace_image.copy()}
+    redraw_fireplace(template, template["surface"].get_rect())
+    return template
+
+def spawn_explosion(x, y):
+    """Start an explosion animation with its upper left at x, y"""
+    explosion_pool.spawn(x, y, game_time())
 
 def detect_collisions():
-    global current_player_image, present_list,game_data
-    global current_player_mask, explosion_list
+    global current_player_image, game_data, current_player_mask
     current_level = game_data["current_level"]
     
-    bag_mask = pygame.mask.from_surface(bag_image)
-    
     #detect collsions between the guided missile/bag and the players star
     if game_data["guided_bag_active"] and game_data["star_active"]:
         if bag_rect.colliderect(star_rect):
@@ -499,15 +1258,10 @@ def detect_collisions():
             game_data["star_active"] = False
             game_data["player_score"] += level_data[current_level]["guided_bag_points"]
             play_sound(bang_sound)
-            rect = pygame.Rect(bag_rect.x,bag_rect.y, explosion_graphics[0].get_width(), explosion_graphics[0].get_height())
             #spawn an explosion at this point
+            spawn_explosion(bag_rect.x, bag_rect.y)
             current_player_image = player_image_star
-            current_player_mask = pygame.mask.from_surface(player_image_star)
-            explosion = { "frame":0,
-                        "rect":rect,
-                        "time": time.time()
-                        }            
-            explosion_list.append(explosion)
+            current_player_mask = get_mask(player_image_star)
             
     #check between the guided missile/bag and the player:
     if game_data["guided_bag_active"]:
@@ -517,27 +1271,21 @@ def detect_collisions():
             play_sound(bang_sound)
             game_data["guided_bag_active"] = False
             game_data["star_active"] = False
-            game_data["game_state"] = GAME_STATE_GAME_OVER
-            pygame.time.wait(2000)
+            game_data["game_state"] = GAME_STATE_PLAYER_HIT
             return  # Exit the function immediately after ending the game
             
     #check collsions between the star and invaders
     if game_data["star_active"]:
-        for row in range(5):
-            for col in range(11):
-                if invaders[row][col]["active"]: #is there an active invader here
-                    invader_rect = invaders[row][col]["rect"]
-                    if invader_rect.colliderect(star_rect):
-                        game_data["invader_speed_add"] += .1
-                        play_sound(bang_sound)
-                        invaders[row][col]["active"] = False
-                        invaders[row][col]["exploding"] = True
-                        invaders[row][col]["explode_frame"] = 0
-                        invaders[row][col]["explode_time"] = time.time()
-                        game_data["star_active"] = False
-                        current_player_image = player_image_star
-                        current_player_mask = pygame.mask.from_surface(player_image_star)
-                        game_data["player_score"] += level_data[current_level]["invader_points"]
+        hit = find_invader_hit(star_rect)
+        if hit is not None:
+            row, col = hit
+            game_data["invader_speed_add"] += .1
+            play_sound(bang_sound)
+            invaders.kill(row, col)
+            game_data["star_active"] = False
+            current_player_image = player_image_star
+            current_player_mask = get_mask(player_image_star)
+            game_data["player_score"] += level_data[current_level]["invader_points"]
                         
     #deal only with active fireplaces                    
     active_fireplaces = [fireplace for fireplace in fireplaces if fireplace["active"]]
@@ -549,19 +1297,14 @@ def detect_collisions():
             if fireplace["mask"].overlap(star_mask, offset):
                 # Erode the fireplace
                 current_player_image = player_image_star
-                current_player_mask = pygame.mask.from_surface(player_image_star)
+                current_player_mask = get_mask(player_image_star)
                 center = (star_rect.centerx, star_rect.centery)
                 erode_fireplace(fireplace, (star_rect.x, star_rect.y), explosion_graphics[0].get_width()//4)
                 game_data["star_active"] = False
                 x = star_rect.centerx - explosion_graphics[0].get_width()//2
                 y = star_rect.centery - explosion_graphics[0].get_height()//2
                 play_sound(bang_sound)
-                rect = pygame.Rect(x,y, explosion_graphics[0].get_width(), explosion_graphics[0].get_height())
-                explosion = { "frame":0,
-                            "rect":rect,
-                            "time": time.time()
-                            }            
-                explosion_list.append(explosion)
+                spawn_explosion(x, y)
                 fireplace["num_hit"] += 1
                 
     #now do the same check as above with the guideed santa bag/missile
@@ -574,157 +1317,104 @@ def detect_collisions():
                 santa_bag_sound.stop()
                 x = bag_rect.centerx - explosion_graphics[0].get_width() // 2
                 y = bag_rect.centery - explosion_graphics[0].get_height() // 2
-                rect = pygame.Rect(
-                    x, y, 
-                    explosion_graphics[0].get_width(), 
-                    explosion_graphics[0].get_height()
-                )
-                explosion = {
-                    "frame": 0,
-                    "rect": rect,
-                    "time": time.time()
-                }
-                explosion_list.append(explosion)
+                spawn_explosion(x, y)
                 fireplace["num_hit"] += 1
-                # Erode the fireplace where the present hit
+                # Erode the fireplace where the bag hit
                 erode_fireplace(
                     fireplace, 
                     (bag_rect.centerx,bag_rect.centery), 
                     explosion_graphics[0].get_width() // 3
                 )
                 
-    # Check collisions between a present and the player and fireplaces
-    # Initialize a new list for remaining presents.  If a present is NOT
-    #destroyed it gets added to this list
-    
-    remaining_presents = []
-
-    for present in present_list:
+    # Check collisions between a present and the player and fireplaces.
+    # Presents that hit a fireplace are marked inactive and removed from
+    # the pool once every present has been checked
+    for present in present_pool:
+        present_rect = present.rect
         # Check collision with the player
-        offset = (present.x - player_rect.x, present.y - player_rect.y)
+        offset = (present_rect.x - player_rect.x, present_rect.y - player_rect.y)
         if current_player_mask.overlap(present_mask, offset):
             play_sound(bang_sound)
-            game_data["game_state"] = GAME_STATE_GAME_OVER
-            pygame.time.wait(2000)
+            game_data["game_state"] = GAME_STATE_PLAYER_HIT
             return  # Exit the function immediately after ending the game
             
         # Check collision with presents and active fireplaces
-        collided_with_fireplace = False
         if game_data["fireplaces_active"]:
             for fireplace in active_fireplaces:
-                offset = (present.x - fireplace["x"], present.y - fireplace["y"])
+                offset = (present_rect.x - fireplace["x"], present_rect.y - fireplace["y"])
                 if fireplace["mask"].overlap(present_mask, offset):
-                    collided_with_fireplace = True
+                    present.active = False
                     
                     # Play explosion sound and add visual feedback
-                    x = present.centerx - explosion_graphics[0].get_width() // 2
-                    y = present.centery - explosion_graphics[0].get_height() // 2
+                    x = present_rect.centerx - explosion_graphics[0].get_width() // 2
+                    y = present_rect.centery - explosion_graphics[0].get_height() // 2
                     play_sound(bang_sound)
-                    
-                    rect = pygame.Rect(
-                        x, y, 
-                        explosion_graphics[0].get_width(), 
-                        explosion_graphics[0].get_height()
-                    )
-                    explosion = {
-                        "frame": 0,
-                        "rect": rect,
-                        "time": time.time()
-                    }
-                    explosion_list.append(explosion)
+                    spawn_explosion(x, y)
                     fireplace["num_hit"] += 1
                     # Erode the fireplace where the present hit
                     erode_fireplace(
                         fireplace, 
-                        (present.centerx, present.bottom), 
+                        (present_rect.centerx, present_rect.bottom), 
                         explosion_graphics[0].get_width() // 4
                     )
-        # If the present didn't collide with anything, keep it in the list
-        if not collided_with_fireplace:
-            remaining_presents.append(present)
-
-    # Update the present_list with the remaining presents
-    present_list = remaining_presents
+    present_pool.compact()
 
-    remaining_presents = []
-    collided_with_star = False
     #Now lets check between the star and the remaining presents.  I could
     #have done this in the loop above but it just got crazy.  This is easier to
     #read with only a minor performance hit
     if game_data["star_active"]:
-        for present in present_list:
-            collided_with_star = False
-            if present.colliderect(star_rect):
-                collided_with_star = True
+        for present in present_pool:
+            present_rect = present.rect
+            if present_rect.colliderect(star_rect):
+                present.active = False
                 game_data["star_active"] = False
                 # Play explosion sound and add visual feedback
-                x = present.centerx - explosion_graphics[0].get_width() // 2
-                y = present.centery - explosion_graphics[0].get_height() // 2
+                x = present_rect.centerx - explosion_graphics[0].get_width() // 2
+                y = present_rect.centery - explosion_graphics[0].get_height() // 2
                 play_sound(bang_sound)
                 current_player_image = player_image_star
-                current_player_mask = pygame.mask.from_surface(player_image_star)
-                rect = pygame.Rect(
-                    x, y, 
-                    explosion_graphics[0].get_width(), 
-                    explosion_graphics[0].get_height()
-                )
-                explosion = {
-                    "frame": 0,
-                    "rect": rect,
-                    "time": time.time()
-                }
-                explosion_list.append(explosion)
-            # If the present didn't collide with anything, keep it in the list
-            if not collided_with_star:
-                remaining_presents.append(present)
-    
-        present_list = remaining_presents
-    
-    
+                current_player_mask = get_mask(player_image_star)
+                spawn_explosion(x, y)
+        present_pool.compact()
             
     #finally check collisions between the star and the sleigh at the top                       
     if game_data["santa_sleigh_active"] and game_data["star_active"]:
         if star_rect.colliderect(santa_sleigh_rect):
             game_data["player_score"] += level_data[current_level]["santa_sleigh_points"]
             game_data["santa_sleigh_active"] = False
-            game_data["sleigh_time"] = pygame.time.get_ticks()
+            game_data["sleigh_time"] = game_ticks()
             game_data["star_active"] = False
             current_player_image = player_image_star
-            current_player_mask = pygame.mask.from_surface(player_image_star)
-            x = santa_sleigh_rect.x
-            y = santa_sleigh_rect.y
+            current_player_mask = get_mask(player_image_star)
             play_sound(bang_sound)
-            rect = pygame.Rect(x,y, explosion_graphics[0].get_width(), explosion_graphics[0].get_height())
-            explosion = { "frame":0,
-                            "rect":rect,
-                            "time": time.time()
-                            }            
-            explosion_list.append(explosion)
+            spawn_explosion(santa_sleigh_rect.x, santa_sleigh_rect.y)
     
         
-def get_input():
+def get_input(keys=None):
+    """Move and fire for the player.  keys defaults to the real keyboard"""
     global current_player_image, star_active, star_rect, player_rect
     global playerpos, game_data, current_player_mask 
     
-    keys = pygame.key.get_pressed()
+    if keys is None:
+        keys = pygame.key.get_pressed()
+    # like every other speed, the player's is in 2048x1536 pixels
+    player_step = round(game_data["player_speed"] * SCALE_FACTOR)
     if keys[pygame.K_LEFT]:
-        player_rect.x -= game_data["player_speed"]
+        player_rect.x -= player_step
         # Prevent moving off-screen
         if player_rect.x < 0:
             player_rect.x = 0
 
     # Move player right
     if keys[pygame.K_RIGHT]:
-        player_rect.x += game_data["player_speed"]
+        player_rect.x += player_step
         # Prevent moving off-screen
         if player_rect.x > SCREEN_WIDTH - player_width:
             player_rect.x = SCREEN_WIDTH - player_width
             
         # cheat code S destroys all invaders
     if keys[pygame.K_s]:
-        for row in invaders:
-            for invader in row:
-                invader["active"] = False
+        invaders.clear()
         
             
     # PLayer fire shot
@@ -732,27 +1422,41 @@ def get_input():
         if game_data["star_active"] == False:
             game_data["star_active"] = True
         current_player_image = player_image_nostar
-        current_player_mask = pygame.mask.from_surface(player_image_nostar)
+        current_player_mask = get_mask(player_image_nostar)
         play_sound(player_shoot_sound)
-        x = player_rect.centerx- (15*SCALE_FACTOR)
-        y = player_rect.y
-        star_rect = pygame.Rect(x, y, star_width, star_height)
+        star_rect.x = player_rect.centerx- (15*SCALE_FACTOR)
+        star_rect.y = player_rect.y
         game_data["star_active"] = True 
 
-def make_invaders_array():
-    invaders = [
-        [
-        {"active": True, 
-        "rect": invader_image.get_rect(),
-        "exploding":False,
-        "explode_frame": 0,
-        "explode_time": 0} for _ in range(11)]
-        for _ in range(5)
-    ]
-    return invaders
+def invader_position(row, col):
+    """Return the screen x, y of the invader at row, col in the formation"""
+    # invaders are spaced half an invader apart, so the grid pitch is 1.5
+    # invaders in each direction from the upper left of the formation
+    x = int(invaders_pos[0]) + col * (invader_width + invader_width//2)
+    y = int(invaders_pos[1]) + row * (invader_height + invader_height//2)
+    return x, y
+
+def find_invader_hit(rect):
+    """Return (row, col) of the lowest active invader overlapping rect, or None"""
+    # The formation is a regular grid, so the cells rect can overlap are
+    # computed directly from its edges instead of testing every invader
+    pitch_x = invader_width + invader_width//2
+    pitch_y = invader_height + invader_height//2
+    origin_x, origin_y = invader_position(0, 0)
+    first_col = max(0, (rect.left - origin_x - invader_width) // pitch_x + 1)
+    last_col = min(invaders.cols - 1, (rect.right - origin_x - 1) // pitch_x)
+    first_row = max(0, (rect.top - origin_y - invader_height) // pitch_y + 1)
+    last_row = min(invaders.rows - 1, (rect.bottom - origin_y - 1) // pitch_y)
+
+    # the star travels up, so the lowest invader in its way is hit first
+    for row in range(last_row, first_row - 1, -1):
+        for col in range(first_col, last_col + 1):
+            if invaders.is_active(row, col):
+                return row, col
+    return None
     
 def make_fireplaces_array():
-    
+    fireplaces = []
     
     # Calculate the gap width
     total_gap_space = SCREEN_WIDTH - (4 * fireplace_width)  
@@ -760,35 +1464,48 @@ def make_fireplaces_array():
 
     for i in range (4):
         x = (gap_width * (i + 1)) + (fireplace_width * i)
+        # every fireplace starts out sharing the template's mask and surface
+        # and gets its own copies when it is first hit
         fireplace = {
             "active": True,
             "x": x,
             "y": fireplace_y,
             "num_hit": 0,
-            "rect": fireplace_image.get_rect(),
-            "surface": fireplace_image.copy(),
-            "mask": pygame.mask.from_surface(fireplace_image),
+            "surface": fireplace_template["surface"],
+            "mask": fireplace_template["mask"],
+            "shared": True,
         }
         fireplaces.append( fireplace )
     return fireplaces
+
+def fireplace_damage(fireplace):
+    """Return the fraction of fireplace that has been shot away.  A
+    fireplace that is out of play counts as destroyed"""
+    if not fireplace["active"] or not game_data["fireplaces_active"]:
+        return 1.0
+    return 1 - fireplace["mask"].count() / fireplace_template["mask"].count()
     
 def check_level_end():
     global current_level
+    # a player hit on the step that cleared the level still ends the game
+    if game_data["game_state"] != GAME_STATE_RUNNING:
+        return
     # Check if there are any active Santas
-    has_active_invaders = any(invader["active"] for row in invaders for invader in row)
-    
-    if not has_active_invaders:
+    if not invaders.alive:
         # Trigger level completion or game state change
         pygame.mixer.stop()
-        pygame.time.wait(3000);
-        start_next_level()
+        if HEADLESS:
+            start_next_level()
+        else:
+            # main() starts the next level after a short pause
+            game_data["game_state"] = GAME_STATE_LEVEL_OVER
 
 def start_next_level():
     global  current_player_image, current_player_mask, star_rect, invaders
-    global invaders_pos, present_list, fireplaces, snowflakes
+    global invaders_pos, fireplaces
     global game_data, invader_image, invader_width, invader_height
     
-    play_next_song()
+    music_player.play_next()
     #assume we have not completed all levels and we will not load a
     #random enemy image
     random_image = False
@@ -807,43 +1524,452 @@ def start_next_level():
 
     #reset player images
     current_player_image = player_image_star
-    current_player_mask = pygame.mask.from_surface(player_image_star)
+    current_player_mask = get_mask(player_image_star)
     player_rect.x = SCREEN_WIDTH// 2 - player_width // 2
     player_rect.y = SCREEN_HEIGHT - player_height
-    star_rect = star_image.get_rect()
+    star_rect.topleft = (0, 0)
     
     # Reset Santa sleigh
     game_data["santa_sleigh_active"] = False
-    game_data["sleigh_time"] = pygame.time.get_ticks()
+    game_data["sleigh_time"] = game_ticks()
     
     # Reset Invaders
-    # Initialize invaders with dictionaries
-    invaders = make_invaders_array()
+    invaders = InvaderFormation()
     
     if random_image:
         image_num = random.randint(0,len(level_data)-1)
     else:
         image_num = current_level
-    #load the levels ebnemy image
-    invader_image_file = level_data[image_num]["image_file"]
-    invader_image = pygame.image.load(invader_image_file).convert_alpha()
-    invader_image = scale_image_by(invader_image, SCALE_FACTOR, SCALE_FACTOR)
+    #the levels enemy image was loaded and scaled at startup
+    invader_image = assets.level_image(image_num)
     invader_width, invader_height = invader_image.get_size()
 
     #reset the postion of the upper left of the enemty formation
     invaders_pos = [0, 120+(game_data["current_level"]*20)*SCALE_FACTOR]
     game_data["invaders_dir"] = LEFT
     
-    # Reset presents
-    present_list = []
+    # nothing should be drawn sliding from where it was in the last level
+    previous_positions.clear()
+
+    # Reset presents and explosions.  A new game restarts the game clock,
+    # so explosions left from the last one would never reach their next frame
+    present_pool.clear()
+    explosion_pool.clear()
     
     # Reset fireplaces
-    fireplaces = []
     fireplaces = make_fireplaces_array()
 
     game_data["fireplaces_active"] = True
     game_data["guided_bag_active"] = False
 
+# ***********************************************************************
+# *                       PROFILING OVERLAY                             *
+# ***********************************************************************
+def record_profile_sample(phase_times, frame_ms):
+    """Store the timings of one running frame in the rolling profile.
+
+    phase_times holds the milliseconds spent in each of PROFILE_PHASES and
+    frame_ms is the time since the previous frame, including the wait for
+    the frame limit.  Samples are only kept while the overlay is shown, and
+    only for the last PROFILE_SECONDS whatever the frame rate.
+    """
+    # every whole frame period beyond the first is a frame we didn't show
+    frame_period = 1000 / TARGET_FPS
+    profile_data["dropped_frames"] += max(0, round(frame_ms / frame_period) - 1)
+    if not game_data["show_fps"]:
+        return
+    now = round(time.perf_counter() - profile_data["start_time"], 4)
+    channels = sum(1 for channel in mixer_channels if channel.get_busy())
+    profile_samples.append((now, frame_ms, *phase_times, len(present_pool),
+                            len(explosion_pool), channels, profile_data["dropped_frames"]))
+    while profile_samples[0][0] < now - PROFILE_SECONDS:
+        profile_samples.popleft()
+
+def draw_profile_overlay():
+    """Draw frame times, phase timings and object counts in the lower left"""
+    line_height = profile_font.get_linesize()
+    graph_width = int(480 * SCALE_FACTOR) + 120
+    graph_height = int(160 * SCALE_FACTOR) + 40
+    lines = [f"FPS: {clock.get_fps():.0f}   dropped frames: {profile_data['dropped_frames']}"]
+    if profile_samples:
+        last = profile_samples[-1]
+        lines.append("  ".join(f"{name} {ms:.2f}" for name, ms in zip(PROFILE_PHASES, last[2:7])) + " ms")
+        lines.append(f"presents {last[7]}   explosions {last[8]}   channels {last[9]}")
+    if UPSCALING:
+        lines.append(f"drawn at {SCREEN_WIDTH}x{SCREEN_HEIGHT}, {render_data['upscaler']} "
+                     f"to {WINDOW_WIDTH}x{WINDOW_HEIGHT}   U = change upscaler")
+    lines.append(f"C = save last {PROFILE_SECONDS}s to CSV")
+
+    rendered = [profile_font.render(line, True, pygame.Color("coral")) for line in lines]
+    graph_width = max([graph_width] + [text.get_width() + 10 for text in rendered])
+    panel = pygame.Surface((graph_width, graph_height + line_height * len(lines) + 10), pygame.SRCALPHA)
+    panel.fill((0, 0, 0, 170))
+    for i, text in enumerate(rendered):
+        panel.blit(text, (5, 5 + i * line_height))
+
+    # rolling frame time graph, with the 60 FPS frame budget as a red line.
+    # The graph tops out at three frame budgets
+    top = line_height * len(lines) + 10
+    max_ms = 3000 / TARGET_FPS
+    budget_y = top + graph_height - int(graph_height * (1000 / TARGET_FPS) / max_ms)
+    pygame.draw.line(panel, (255, 0, 0), (0, budget_y), (graph_width, budget_y))
+    recent = list(profile_samples)[-graph_width // 2:]
+    if len(recent) > 1:
+        points = [(i * 2, top + graph_height - int(graph_height * min(sample[1], max_ms) / max_ms))
+                  for i, sample in enumerate(recent)]
+        pygame.draw.lines(panel, (0, 255, 0), False, points)
+    return screen.blit(panel, (10, SCREEN_HEIGHT - panel.get_height() - 10))
+
+def dump_profile_csv():
+    """Write the rolling profile samples to a time stamped CSV file"""
+    if not profile_samples:
+        # samples are only kept while the overlay is on
+        print("Profiling is off, press F to turn it on before saving")
+        return
+    filename = datetime.datetime.now().strftime("profile_%Y%m%d_%H%M%S.csv")
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(PROFILE_COLUMNS)
+        writer.writerows(profile_samples)
+    print(f"Saved {len(profile_samples)} profile samples to {filename}")
+
+# ***********************************************************************
+# *                       GAME STATES                                   *
+# ***********************************************************************
+# Every game state has a row in GAME_STATES with hooks that main() calls
+# once per frame: "enter" when the state starts, "event" for each event,
+# then "update" and "draw".  Idle states only draw when something changed
+# and sleep in pygame.event.wait() between frames instead of spinning.
+# States with a timer set state_data["deadline"] when they start and move
+# on in their update hook once it has passed.
+
+def start_state_timer(milliseconds):
+    """Move on from the current state after milliseconds"""
+    state_data["deadline"] = pygame.time.get_ticks() + milliseconds
+
+def state_timer_done():
+    return pygame.time.get_ticks() >= state_data["deadline"]
+
+def wait_for_events(timeout):
+    """Sleep until an event arrives or timeout milliseconds pass"""
+    # a timeout of 0 would make pygame wait forever
+    event = pygame.event.wait(max(1, timeout))
+    events = [] if event.type == pygame.NOEVENT else [event]
+    return events + pygame.event.get()
+
+def draw_centered_text(text, y, color, shadow_color):
+    """Draw text centered across the screen with a drop shadow"""
+    text_surface = font.render(text, True, color)
+    shadow_surface = font.render(text, True, shadow_color)
+    x = SCREEN_WIDTH // 2 - text_surface.get_width() // 2
+    screen.blit(shadow_surface, (x + 5, y + 5))
+    screen.blit(text_surface, (x, y))
+
+def enter_title():
+    #stop all sounds and music during title screen
+    pygame.mixer.stop()
+    pygame.mixer.music.pause()
+
+def title_event(event):
+    if event.type == pygame.KEYDOWN:
+        if event.key == pygame.K_SPACE:
+            start_new_game()
+        if event.key == pygame.K_ESCAPE:
+            game_data["game_state"] = GAME_STATE_QUIT
+
+def draw_title():
+    screen.blit(title_screen_image, (0, 0))
+    present()
+
+def enter_running():
+    # start timing afresh when play comes back from another screen
+    frame_timing["last_time"] = None
+    frame_timing["accumulator"] = SIM_STEP_MS
+    request_full_redraw()
+
+def running_event(event):
+    if event.type == pygame.KEYDOWN:
+        if event.key == pygame.K_ESCAPE:
+            game_data["game_state"] = GAME_STATE_QUIT
+        if event.key == pygame.K_p:
+            game_data["game_state"] = GAME_STATE_PAUSED
+            input_log["pause_pending"] = True
+        if event.key == pygame.K_f:
+            game_data["show_fps"] = not game_data["show_fps"]
+        if event.key == pygame.K_c:
+            dump_profile_csv()
+        if event.key == pygame.K_u and UPSCALING:
+            upscaler = UPSCALERS[(UPSCALERS.index(render_data["upscaler"]) + 1) % len(UPSCALERS)]
+            set_upscaler(upscaler)
+
+def update_running():
+    """Catch the simulation up with real time in fixed steps.
+
+    Each phase is timed for the profiling overlay.
+    """
+    now = time.perf_counter()
+    if frame_timing["last_time"] is not None:
+        frame_timing["accumulator"] += (now - frame_timing["last_time"]) * 1000
+    frame_timing["last_time"] = now
+    accumulator = min(frame_timing["accumulator"], MAX_STEPS_PER_FRAME * SIM_STEP_MS)
+    phase_times = [0.0] * len(PROFILE_PHASES)
+    while accumulator >= SIM_STEP_MS and game_data["game_state"] == GAME_STATE_RUNNING:
+        keys = next_step_keys()
+        if keys is None:
+            break
+        save_previous_positions()
+        advance_game_clock()
+        for i, phase in enumerate((lambda: get_input(keys), update, detect_collisions)):
+            start = time.perf_counter()
+            phase()
+            phase_times[i] += (time.perf_counter() - start) * 1000
+        check_level_end()
+        accumulator -= SIM_STEP_MS
+    frame_timing["accumulator"] = accumulator
+    frame_timing["phase_times"] = phase_times
+
+def draw_running():
+    """Draw the frame part way between the last two simulation steps"""
+    phase_times = frame_timing["phase_times"]
+    start = time.perf_counter()
+    draw_scene(frame_timing["accumulator"] / SIM_STEP_MS)
+    phase_times[3] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    update_display()
+    phase_times[4] = (time.perf_counter() - start) * 1000
+    dt = clock.tick(FRAME_CAP)
+    record_profile_sample(phase_times, dt)
+
+def pause_event(event):
+    if event.type == pygame.KEYDOWN:
+        if event.key == pygame.K_p:  # Resume game
+            game_data["game_state"] = GAME_STATE_RUNNING
+        if event.key == pygame.K_q:  # Quit game
+            game_data["game_state"] = GAME_STATE_QUIT
+
+def draw_pause():
+    """Draw the pause message over the frozen game"""
+    draw_centered_text("PAUSED", SCREEN_HEIGHT // 3, (255, 0, 0), (0, 128, 0))
+    draw_centered_text("Press P to Resume or Q to Quit", SCREEN_HEIGHT // 2,
+                       (255, 0, 0), (0, 128, 0))
+    present()
+
+def enter_player_hit():
+    start_state_timer(2000)  # give the player a moment to see what hit them
+
+def update_player_hit():
+    if state_timer_done():
+        game_data["game_state"] = GAME_STATE_GAME_OVER
+
+def enter_level_over():
+    start_state_timer(3000)
+
+def update_level_over():
+    if state_timer_done():
+        game_data["game_state"] = GAME_STATE_RUNNING
+        start_next_level()
+
+def enter_game_over():
+    pygame.mixer.stop()
+    player_name = getpass.getuser()  # Retrieve player username
+
+    # Update the high scores with the player's score.  The file is saved
+    # in the background.  Replayed games don't count
+    player_score = game_data["player_score"]
+    finish_recording()
+    if input_log["replay"] is not None:
+        finish_replay()
+        game_over_data["high_scores"] = high_score_store.load()
+    else:
+        game_over_data["high_scores"] = high_score_store.add(player_name, player_score)
+    game_over_data["player_name"] = player_name
+    game_over_data["player_score"] = player_score
+    start_state_timer(4000)  # 4 seconds display
+
+def update_game_over():
+    # After 4 seconds, proceed to the high score screen
+    if state_timer_done():
+        game_data["game_state"] = GAME_STATE_HIGH_SCORES
+
+def draw_game_over():
+    """Draw the large GAME OVER banner over the last game scene"""
+    large_font = pygame.font.Font(font_path, int(200*SCALE_FACTOR))  # Set the font size to double the original
+    game_over_text = large_font.render("GAME OVER", True, (255, 0, 0))  # Red text
+    game_over_shadow = large_font.render("GAME OVER", True, (0, 255, 0))  # Green shadow
+    text_rect = game_over_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
+    shadow_rect = game_over_shadow.get_rect(center=(SCREEN_WIDTH // 2 + 10, SCREEN_HEIGHT // 2 + 10))  # Slight offset for shadow
+    screen.blit(game_over_shadow, shadow_rect)  # First the shadow
+    screen.blit(game_over_text, text_rect)  # Then the text
+    present()
+
+def high_scores_event(event):
+    if event.type == pygame.KEYDOWN:
+        if event.key == pygame.K_q or event.key == pygame.K_ESCAPE:
+            game_data["game_state"] = GAME_STATE_QUIT
+        if event.key == pygame.K_SPACE:
+            game_data["game_state"] = GAME_STATE_TITLE
+
+def draw_high_scores():
+    draw_game_over_screen(game_over_data["high_scores"],
+                          game_over_data["player_name"],
+                          game_over_data["player_score"])
+    present()
+    clock.tick(TARGET_FPS)
+
+# ***********************************************************************
+# *                       HEADLESS SIMULATION                           *
+# ***********************************************************************
+class ScriptedKeys:
+    """Stands in for pygame.key.get_pressed() with a fixed set of held keys"""
+
+    def __init__(self, pressed=()):
+        self.pressed = frozenset(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+def demo_script(frame):
+    """Sweep back and forth across the screen, firing twice a second"""
+    keys = [pygame.K_RIGHT if (frame // 120) % 2 == 0 else pygame.K_LEFT]
+    if frame % 30 == 0:
+        keys.append(pygame.K_SPACE)
+    return keys
+
+def run_headless(frames, script=demo_script):
+    """Simulate up to frames fixed steps from a new game without drawing.
+
+    script is called with the frame number and returns the keys held down
+    during that frame.  The run stops early if the game ends, and the number
+    of frames simulated is returned.
+    """
+    reset_game(True)
+    for frame in range(frames):
+        advance_game_clock()
+        get_input(ScriptedKeys(script(frame)))
+        update()
+        detect_collisions()
+        if game_data["game_state"] != GAME_STATE_RUNNING:
+            return frame + 1
+        check_level_end()
+    return frames
+
+# ***********************************************************************
+# *                       INPUT RECORDING AND REPLAY                    *
+# ***********************************************************************
+# Every simulation step takes its keys from next_step_keys(), which reads
+# the keyboard, adds the keys to the recording when --record is on, or
+# takes them from the recording being replayed.  A game is only recorded
+# or replayed from its start, right after the random numbers are seeded.
+
+def input_bits(keys):
+    """Return the INPUT_* bits for the keys held down in keys"""
+    bits = 0
+    if keys[pygame.K_LEFT]:
+        bits |= INPUT_LEFT
+    if keys[pygame.K_RIGHT]:
+        bits |= INPUT_RIGHT
+    if keys[pygame.K_SPACE] or keys[pygame.K_UP]:
+        bits |= INPUT_FIRE
+    if keys[pygame.K_s]:
+        bits |= INPUT_CHEAT
+    return bits
+
+def keys_for_bits(bits):
+    """Return the list of keys get_input() needs to see for bits"""
+    return [key for bit, key in INPUT_KEYS if bits & bit]
+
+def start_new_game():
+    """Start a game from the title screen, recording or replaying it if asked"""
+    replay = input_log["replay"]
+    if replay is not None:
+        random.seed(replay.seed)
+    elif input_log["record_file"] is not None:
+        seed = options.seed if options.seed is not None else random.getrandbits(62)
+        random.seed(seed)
+        input_log["recording"] = InputRecording(seed, SCREEN_WIDTH, SCREEN_HEIGHT)
+    input_log["step"] = 0
+    input_log["paused_step"] = None
+    reset_game(True)
+
+def next_step_keys():
+    """Return the keys for the next simulation step, or None to take no step.
+
+    A replay stops to show the pause screen where the player paused, and
+    returns to the title screen if it runs out of steps before the game ends.
+    """
+    replay = input_log["replay"]
+    step = input_log["step"]
+    if replay is not None:
+        if step >= len(replay.inputs):
+            finish_replay()
+            game_data["game_state"] = GAME_STATE_TITLE
+            return None
+        bits = replay.inputs[step]
+        if bits & INPUT_PAUSE and input_log["paused_step"] != step:
+            input_log["paused_step"] = step
+            game_data["game_state"] = GAME_STATE_PAUSED
+            return None
+    else:
+        bits = input_bits(pygame.key.get_pressed())
+        if input_log["recording"] is not None:
+            if input_log["pause_pending"]:
+                bits |= INPUT_PAUSE
+            input_log["recording"].inputs.append(bits)
+        input_log["pause_pending"] = False
+    input_log["step"] = step + 1
+    return STEP_KEYS[bits & INPUT_KEY_BITS]
+
+def finish_recording():
+    """Save the game being recorded, if there is one"""
+    recording = input_log["recording"]
+    if recording is None:
+        return
+    recording.score = game_data["player_score"]
+    recording.save(input_log["record_file"])
+    print(f"Recorded {len(recording.inputs)} steps to {input_log['record_file']}")
+    input_log["recording"] = None
+    input_log["record_file"] = None  # only the first game is recorded
+
+def finish_replay():
+    """Report whether the replay ended with the recorded score"""
+    replay = input_log["replay"]
+    if replay is None:
+        return
+    report_replay(replay, game_data["player_score"], input_log["step"])
+    input_log["replay"] = None
+
+def report_replay(recording, score, steps):
+    if score == recording.score and steps == len(recording.inputs):
+        print(f"Replayed {steps} steps, score {score} matches the recording")
+    else:
+        print(f"Replay went out of sync: {steps} of {len(recording.inputs)} steps, "
+              f"score {score} instead of {recording.score}")
+
+def replay_headless(recording):
+    """Replay recording as fast as possible without drawing"""
+    random.seed(recording.seed)
+    steps = run_headless(len(recording.inputs),
+                         lambda frame: keys_for_bits(recording.inputs[frame]))
+    report_replay(recording, game_data["player_score"], steps)
+    return steps
+
+def record_headless(frames, filename, script=demo_script):
+    """Run a headless game with script and save it as a recording"""
+    seed = options.seed
+    recording = InputRecording(seed, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    def recorded_script(frame):
+        keys = script(frame)
+        recording.inputs.append(input_bits(ScriptedKeys(keys)))
+        return keys
+
+    random.seed(seed)
+    steps = run_headless(frames, recorded_script)
+    recording.score = game_data["player_score"]
+    recording.save(filename)
+    print(f"Recorded {steps} steps to {filename}")
+    return steps
+
 # ***********************************************************************
 # *                       GAME STATE INFO                               *
 # ***********************************************************************
@@ -857,11 +1983,68 @@ GAME_STATE_PAUSED = 3
 GAME_STATE_QUIT = 4
 GAME_STATE_GAME_OVER = 5
 GAME_STATE_LEVEL_OVER = 6
+GAME_STATE_PLAYER_HIT = 7
+GAME_STATE_HIGH_SCORES = 8
 
 EXPLOSION_FRAME_DURATION = 0.035
+TARGET_FPS = 60
+
+# The simulation always advances in fixed 1/60s steps, which is the rate all
+# of the speeds in the game were tuned for.  Drawing happens at whatever
+# rate the machine manages and blends positions between the last two steps
+SIM_STEP_MS = 1000 / 60
+MAX_STEPS_PER_FRAME = 5  # stop a slow machine falling further and further behind
+sim_steps = 0
+previous_positions = {}  # positions before the last step, for drawing
+
+# per frame hooks for each state, see GAME STATES above
+GAME_STATES = {
+    GAME_STATE_TITLE: {"enter": enter_title, "event": title_event,
+                       "update": None, "draw": draw_title, "idle": True},
+    GAME_STATE_RUNNING: {"enter": enter_running, "event": running_event,
+                         "update": update_running, "draw": draw_running, "idle": False},
+    GAME_STATE_PAUSED: {"enter": None, "event": pause_event,
+                        "update": None, "draw": draw_pause, "idle": True},
+    GAME_STATE_PLAYER_HIT: {"enter": enter_player_hit, "event": None,
+                            "update": update_player_hit, "draw": None, "idle": True},
+    GAME_STATE_LEVEL_OVER: {"enter": enter_level_over, "event": None,
+                            "update": update_level_over, "draw": None, "idle": True},
+    GAME_STATE_GAME_OVER: {"enter": enter_game_over, "event": None,
+                           "update": update_game_over, "draw": draw_game_over, "idle": True},
+    GAME_STATE_HIGH_SCORES: {"enter": None, "event": high_scores_event,
+                             "update": update_game_over_snow, "draw": draw_high_scores,
+                             "idle": False},
+}
+IDLE_WAIT_MS = 1000  # longest an idle screen sleeps without an event
+state_data = {"current": None, "deadline": None, "redraw": True}
+frame_timing = {"last_time": None, "accumulator": SIM_STEP_MS, "phase_times": None}
+game_over_data = {}
+
+# keys for each simulation step, packed into a byte for recordings
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_FIRE = 4
+INPUT_PAUSE = 8
+INPUT_CHEAT = 16  # the S key, recorded so a game that used it still replays
+INPUT_KEY_BITS = INPUT_LEFT | INPUT_RIGHT | INPUT_FIRE | INPUT_CHEAT
+INPUT_KEYS = ((INPUT_LEFT, pygame.K_LEFT), (INPUT_RIGHT, pygame.K_RIGHT),
+              (INPUT_FIRE, pygame.K_SPACE), (INPUT_CHEAT, pygame.K_s))
+STEP_KEYS = [ScriptedKeys(keys_for_bits(bits)) for bits in range(INPUT_KEY_BITS + 1)]
+input_log = {"record_file": None, "recording": None, "replay": None,
+             "step": 0, "pause_pending": False, "paused_step": None}
+
+# shape of the hole a hit leaves in a fireplace, one of EROSION_BRUSH_MAKERS
+EROSION_BRUSH_SHAPE = "circle"
+EROSION_BRUSH_MAKERS = {"circle": make_circle_brush,
+                        "jagged": make_jagged_brush}
 LEFT = -1
 RIGHT = 1
 HIGH_SCORES_FILE = "highscores.txt"
+# how the sprite images are held, see the --sprites option
+SPRITE_MODES = ("separate", "atlas", "rle", "atlas-rle")
+COLORKEY = (255, 0, 255)  # the clear colour of sprites that have no soft edges
+# ways of scaling the game up to the window, see --render-resolution
+UPSCALERS = ("scale", "smoothscale", "scaled")
     
 #***********************************************************************
 #*                       PYGAME INIT and setup                         *
@@ -877,28 +2060,146 @@ resolutions = [
     (2048, 1536,1)
 ]
 
+# Options come from the command line when run as a script and from the
+# environment when imported by another tool.  They are read here because
+# headless mode and the resolution have to be known before pygame starts
+RESOLUTION_NAMES = ["%dx%d" % entry[:2] for entry in resolutions]
+parser = argparse.ArgumentParser(description="Santavaders")
+parser.add_argument("--headless", action="store_true",
+                    default=os.environ.get("SANTAVADERS_HEADLESS") == "1",
+                    help="simulate without a window, sound or frame limit")
+parser.add_argument("--seed", type=int, default=os.environ.get("SANTAVADERS_SEED"),
+                    help="seed for every random number the game uses")
+parser.add_argument("--frames", type=int, default=3600,
+                    help="number of frames a headless run simulates")
+parser.add_argument("--resolution", default=os.environ.get("SANTAVADERS_RESOLUTION"),
+                    choices=RESOLUTION_NAMES,
+                    help="window size from the resolutions table, e.g. 1024x768")
+parser.add_argument("--render-resolution", default=os.environ.get("SANTAVADERS_RENDER_RESOLUTION"),
+                    choices=RESOLUTION_NAMES,
+                    help="draw the game at this smaller size from the resolutions table "
+                         "and scale it up to the window, which is faster on slow machines.  "
+                         "It is fixed for the whole run; U only changes the upscaler")
+parser.add_argument("--upscale", choices=UPSCALERS,
+                    default=os.environ.get("SANTAVADERS_UPSCALE", "scale"),
+                    help="scale: sharp and quick.  smoothscale: filtered, slower.  "
+                         "scaled: SDL scales on the graphics card.  U switches while playing")
+parser.add_argument("--dirty-rects", action="store_true",
+                    default=os.environ.get("SANTAVADERS_DIRTY_RECTS") == "1",
+                    help="only redraw and update the parts of the screen that changed")
+parser.add_argument("--fps", type=int, default=os.environ.get("SANTAVADERS_FPS", 60),
+                    help="frame rate cap, 0 for no cap.  The game speed does not depend on it")
+parser.add_argument("--vsync", action="store_true",
+                    default=os.environ.get("SANTAVADERS_VSYNC") == "1",
+                    help="wait for the display's vertical sync instead of a frame cap")
+parser.add_argument("--snowflakes", type=int, default=os.environ.get("SANTAVADERS_SNOWFLAKES"),
+                    help="number of falling snowflakes (default 200 at the largest window)")
+parser.add_argument("--image-cache-mb", type=float, default=os.environ.get("SANTAVADERS_IMAGE_CACHE_MB"),
+                    help="most memory the sprite images may use before level images not in use are "
+                         "dropped, with --sprites separate or rle")
+parser.add_argument("--music-prefetch-mb", type=float,
+                    default=os.environ.get("SANTAVADERS_MUSIC_PREFETCH_MB", 16),
+                    help="music tracks up to this size are read into memory before they play.  "
+                         "Up to twice this is held, for the playing track and the next.  "
+                         "0 streams every track from disk")
+parser.add_argument("--sprites", choices=SPRITE_MODES, default=os.environ.get("SANTAVADERS_SPRITES", "separate"),
+                    help="separate: one surface per sprite.  atlas: every sprite in one surface.  "
+                         "rle: run length encoded blits, the fastest to draw but sprite edges "
+                         "may blend a shade differently.  atlas-rle: both")
+parser.add_argument("--record", default=os.environ.get("SANTAVADERS_RECORD"),
+                    help="save the seed and keys of the first game to this file")
+parser.add_argument("--replay", default=os.environ.get("SANTAVADERS_REPLAY"),
+                    help="play back a recorded game, as fast as possible with --headless")
+options = parser.parse_args(sys.argv[1:] if __name__ == "__main__" else [])
+# argparse doesn't check defaults, which come from the environment, against choices
+for value in (options.resolution, options.render_resolution):
+    if value is not None and value not in RESOLUTION_NAMES:
+        parser.error(f"{value} is not one of the resolutions {', '.join(RESOLUTION_NAMES)}")
+
+# a replay has to run at the resolution it was recorded at.  The window
+# can be bigger if the game is drawn at that resolution
+replay_recording = InputRecording.load(options.replay) if options.replay else None
+if replay_recording is not None:
+    if options.resolution is None:
+        options.resolution = replay_recording.resolution
+    elif (options.render_resolution or options.resolution) != replay_recording.resolution:
+        print(f"Warning: the replay was recorded at {replay_recording.resolution}")
+
+HEADLESS = options.headless
+if HEADLESS:
+    # SDL's dummy drivers let pygame run without a display or sound card
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    if options.seed is None:
+        options.seed = 0
+random.seed(options.seed)
+input_log["record_file"] = options.record
+input_log["replay"] = replay_recording
+
 # Initialize Pygame and open a window to get screen info
 pygame.init()
-info = pygame.display.Info()  # Get current display info
-screen_width = info.current_w
-screen_height = info.current_h-250 #a buffer zone to make sure it fits
-max_resolution = (0, 0,0)
-for width, height, scale in resolutions:
-    if width <= screen_width and height <= screen_height:
-        max_resolution = (width, height, scale)
+if options.resolution:
+    max_resolution = next(entry for entry in resolutions
+                          if "%dx%d" % entry[:2] == options.resolution)
+elif HEADLESS:
+    max_resolution = resolutions[0]  # there is no real screen to fit
+else:
+    info = pygame.display.Info()  # Get current display info
+    screen_width = info.current_w
+    screen_height = info.current_h-250 #a buffer zone to make sure it fits
+    max_resolution = (0, 0,0)
+    for width, height, scale in resolutions:
+        if width <= screen_width and height <= screen_height:
+            max_resolution = (width, height, scale)
 
 #max_resolution = (1024, 768, .5)
 print("Best resolution for this screen:", max_resolution)
-SCREEN_WIDTH = max_resolution[0]
-SCREEN_HEIGHT = max_resolution[1]
-SCALE_FACTOR = max_resolution[2]
-
-# Set up the drawing window
-screen = pygame.display.set_mode( (SCREEN_WIDTH, SCREEN_HEIGHT) )
+WINDOW_WIDTH = max_resolution[0]
+WINDOW_HEIGHT = max_resolution[1]
+
+# The game can be drawn at a smaller entry of the resolutions table and
+# scaled up to the window once per frame.  Everything in the game, from
+# the sprites to the speeds, then works at that smaller size
+render_resolution = max_resolution
+if options.render_resolution:
+    render_resolution = next(entry for entry in resolutions
+                             if "%dx%d" % entry[:2] == options.render_resolution)
+    if render_resolution[0] > WINDOW_WIDTH:
+        print("Warning: the render resolution is bigger than the window, drawing at the window's")
+        render_resolution = max_resolution
+SCREEN_WIDTH = render_resolution[0]
+SCREEN_HEIGHT = render_resolution[1]
+SCALE_FACTOR = render_resolution[2]
+UPSCALING = render_resolution != max_resolution
+
+# Set up the drawing window.  When the game is drawn smaller than the
+# window it is drawn into a surface of its own and present() scales it up
+render_data = {"full_redraw": True, "previous_rects": [], "drawn_rects": [],
+               "upscaler": options.upscale}
+window = open_window()
+screen = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert() if UPSCALING else window
+FRAME_CAP = 0 if options.vsync else options.fps
 icon = pygame.image.load("media/graphics/santa_saucer_smalll.png")
 pygame.display.set_icon(icon)
 pygame.display.set_caption("Santavaders")
 
+# The background is drawn once into its own surface.  In dirty rectangle
+# mode draw_scene() restores just the areas that were drawn over last frame
+# from it and only those areas are sent to the display
+DIRTY_RECT_MODE = options.dirty_rects
+background = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+background.fill((25, 25, 64))
+
+# Show the title screen as soon as the window is open.  Everything else is
+# loaded behind it.  The title screen is never shown in a headless run
+startup_times = {}
+if not HEADLESS:
+    title_screen_image = pygame.image.load("media/graphics/title_screen_alt.png").convert_alpha()
+    title_screen_image = pygame.transform.scale(title_screen_image, (SCREEN_WIDTH, SCREEN_HEIGHT))
+    screen.blit(title_screen_image, (0, 0))
+    present()
+    startup_times["title"] = time.perf_counter() - STARTUP_START
+
 
 #***********************************************************************
 #*                       level info                                     *
@@ -955,6 +2256,59 @@ level_data = [ { "image_file": "media/graphics/santa_saucer_smalll.png",
                 }
                 ]
                 
+#***********************************************************************
+#*                       SPRITE IMAGES                                 *
+#***********************************************************************
+# Every sprite is loaded and scaled once here so that nothing is decoded or
+# scaled from disk while the game is being played
+SPRITE_FILES = ["media/graphics/christmas_tree_star_small.png",
+                "media/graphics/christmas_tree_no_star_small.png",
+                "media/graphics/tree_star_small.png",
+                "media/graphics/guided_bag_small.png",
+                "media/graphics/santa_sleigh_small.png",
+                "media/graphics/fireplace_small.png",
+                "media/graphics/present_small.png"]
+EXPLOSION_FILES = ["media/graphics/explosion"+str(i+1)+".png" for i in range(7)]
+SOUND_FILES = {"santa_sleigh": "media/sounds/santa-claus-laughing.ogg",
+               "player_shoot": "media/sounds/bell_shake.ogg",
+               "santa_shoot": "media/sounds/santa_chuckle.ogg",
+               "bang": "media/sounds/bangmedium.ogg",
+               "santa_bag": "media/sounds/santa_bag_alarm_loud.wav"}
+
+pygame.mixer.pre_init(44100, -16, 2, 2048)
+pygame.mixer.init()
+
+# The images and sounds are decoded on a pool of threads while the title
+# screen shows how far along they are.  Only convert_alpha(), which needs
+# the display, is left for this thread
+image_cache_mb = options.image_cache_mb
+assets = AssetManager(SCALE_FACTOR, None if image_cache_mb is None else image_cache_mb * 1024 * 1024)
+with concurrent.futures.ThreadPoolExecutor(thread_name_prefix="loader") as loader:
+    image_jobs = {filename: loader.submit(decode_image, filename, SCALE_FACTOR, SCALE_FACTOR)
+                  for filename in SPRITE_FILES + EXPLOSION_FILES +
+                                  [level["image_file"] for level in level_data]}
+    sound_jobs = {name: loader.submit(pygame.mixer.Sound, filename)
+                  for name, filename in SOUND_FILES.items()}
+    wait_for_loading(list(image_jobs.values()) + list(sound_jobs.values()))
+for filename, job in image_jobs.items():
+    assets.add(filename, job.result().convert_alpha())
+sounds = {name: job.result() for name, job in sound_jobs.items()}
+SPRITE_MODE = options.sprites
+if SPRITE_MODE in ("atlas", "atlas-rle"):
+    assets.pack()
+if SPRITE_MODE in ("rle", "atlas-rle"):
+    # the fireplace image is copied and shot away, so it stays as it is
+    assets.accelerate(skip=("media/graphics/fireplace_small.png",))
+startup_times["assets"] = time.perf_counter() - STARTUP_START
+
+# collision masks for every sprite, looked up with get_mask().  These must
+# never be changed in place; anything that erodes a mask works on a copy.
+# A mask goes when its surface does, so the registry never keeps an image
+# alive that the asset manager has dropped or replaced
+surface_masks = weakref.WeakKeyDictionary()
+for image in assets.images.values():
+    get_mask(image)
+
 #***********************************************************************
 #*                       General game info                             *
 #***********************************************************************
@@ -983,33 +2337,33 @@ default_game_data = {
 game_data = dict(default_game_data)
 game_data["game_state"] = GAME_STATE_TITLE #set initial game state
 
+# main() reads the high scores, so tools that import the game never touch them
+high_score_store = HighScoreStore(HIGH_SCORES_FILE)
+
 #***********************************************************************
 #*                     SOUNDS AND MUSIC                                *
 #***********************************************************************
-pygame.mixer.pre_init(44100, -16, 2, 2048)
-pygame.mixer.init()
-
-santa_sleigh_sound = pygame.mixer.Sound("media/sounds/santa-claus-laughing.wav")
+santa_sleigh_sound = sounds["santa_sleigh"]
 santa_sleigh_sound.set_volume(1)
 
-player_shoot_sound = pygame.mixer.Sound("media/sounds/bell_shake.wav")
+player_shoot_sound = sounds["player_shoot"]
 player_shoot_sound.set_volume(1)
 
-santa_shoot_sound = pygame.mixer.Sound("media/sounds/santa_chuckle.wav")
+santa_shoot_sound = sounds["santa_shoot"]
 santa_shoot_sound.set_volume(1)
 
-bang_sound = pygame.mixer.Sound("media/sounds/bangMedium.wav")
+bang_sound = sounds["bang"]
 bang_sound.set_volume(1)
 
-santa_bag_sound = pygame.mixer.Sound("media/sounds/santa_bag_alarm_loud.wav")
+santa_bag_sound = sounds["santa_bag"]
 santa_bag_sound.set_volume(1)
 
-song_list = glob.glob("./media/music/*.wav")
-current_song = None
+music_player = MusicPlayer(find_music("media/music"), int(options.music_prefetch_mb * 1024 * 1024))
 pygame.mixer.music.set_volume(0.5)
 
 sound_volume = .5
 pygame.mixer.set_num_channels(64)
+mixer_channels = [pygame.mixer.Channel(i) for i in range(pygame.mixer.get_num_channels())]
 
 END_MUSIC_EVENT = pygame.USEREVENT + 0   
 pygame.mixer.music.set_endevent(END_MUSIC_EVENT)
@@ -1023,24 +2377,35 @@ pygame.font.init()
 font_path = "media/fonts/MountainsofChristmas-Bold.ttf"  # Replace with the path to your font file
 font = pygame.font.Font(font_path, int(100*SCALE_FACTOR))  # Large font size for boldness
 
-#***********************************************************************
-#*                       TITLE IMAGES                                  *
-#***********************************************************************
-# Load the title screen image
-title_screen_image = pygame.image.load("media/graphics/title_screen_alt.png").convert_alpha()
-title_screen_image = pygame.transform.scale(title_screen_image, (SCREEN_WIDTH, SCREEN_HEIGHT))
-
+# The score and level HUD is composed from glyphs pre-rendered once per
+# resolution, and the composed surfaces are cached until the value changes
+HUD_LABELS = ("Score: ", "Level: ")
+HUD_GLYPHS = "0123456789"
+HUD_SHADOW_OFFSET = 5
+hud_atlas = {"text": make_hud_atlas((255, 0, 0)),      # Red text
+             "shadow": make_hud_atlas((0, 128, 0))}    # Green shadow
+hud_text_cache = {}
+
+# The profiling overlay keeps the last PROFILE_SECONDS of running frames
+# while it is shown
+PROFILE_SECONDS = 10
+PROFILE_PHASES = ("input", "update", "collisions", "draw", "flip")
+PROFILE_COLUMNS = ("time_s", "frame_ms") + tuple(name + "_ms" for name in PROFILE_PHASES) + \
+                  ("presents", "explosions", "channels", "dropped_frames")
+profile_font = pygame.font.Font(None, int(24 * SCALE_FACTOR) + 12)
+profile_samples = collections.deque()
+profile_data = {"dropped_frames": 0, "start_time": time.perf_counter()}
 
 #***********************************************************************
 #*                       PLAYER IMAGE AND SETUP                        *
 #***********************************************************************
 
-player_image_star = load_image("media/graphics/christmas_tree_star_small.png", SCALE_FACTOR, SCALE_FACTOR)
-player_image_nostar = load_image("media/graphics/christmas_tree_no_star_small.png", SCALE_FACTOR, SCALE_FACTOR)
+player_image_star = assets.load("media/graphics/christmas_tree_star_small.png")
+player_image_nostar = assets.load("media/graphics/christmas_tree_no_star_small.png")
 player_width, player_height = player_image_star.get_size()
 
 player_rect = player_image_nostar.get_rect() 
-current_player_mask = pygame.mask.from_surface(player_image_star)
+current_player_mask = get_mask(player_image_star)
 current_player_image = player_image_star
 
 #set inital postion and velocity
@@ -1053,28 +2418,27 @@ playerpos = [player_rect.x, player_rect.y]
 #*                       STAR/MISSILE SETUP                            *
 #***********************************************************************
 
-star_image = load_image("media/graphics/tree_star_small.png", SCALE_FACTOR, SCALE_FACTOR)
+star_image = assets.load("media/graphics/tree_star_small.png")
 star_width, star_height = star_image.get_size()
 star_rect = star_image.get_rect()
-star_mask = pygame.mask.from_surface(star_image)
+star_mask = get_mask(star_image)
 
 #***********************************************************************
 #*                       SANTAS GUIDED MISSILE/BAG                     *
 #***********************************************************************
-bag_image = load_image("media/graphics/guided_bag_small.png", SCALE_FACTOR, SCALE_FACTOR)
+bag_image = assets.load("media/graphics/guided_bag_small.png")
 bag_width, bag_height = bag_image.get_size()
 bag_rect = star_image.get_rect()
-bag_mask = pygame.mask.from_surface(bag_image)
+bag_mask = get_mask(bag_image)
 
 #***********************************************************************
 #*                       INVADER SETUP                             *
 #***********************************************************************
 
-invader_image_file = level_data[0]["image_file"]
-invader_image = load_image(invader_image_file, SCALE_FACTOR, SCALE_FACTOR)
+invader_image = assets.level_image(0)
 invader_width, invader_height = invader_image.get_size()
 
-invaders = make_invaders_array()
+invaders = InvaderFormation()
 invaders_pos = [0, int(120*SCALE_FACTOR)]
 
 
@@ -1082,93 +2446,152 @@ invaders_pos = [0, int(120*SCALE_FACTOR)]
 #***********************************************************************
 #*                       SANTA SLEIGH                                  *
 #***********************************************************************
-santa_sleigh_image = load_image("media/graphics/santa_sleigh_small.png", SCALE_FACTOR, SCALE_FACTOR)
+santa_sleigh_image = assets.load("media/graphics/santa_sleigh_small.png")
 santa_sleigh_rect = santa_sleigh_image.get_rect()
 
 #***********************************************************************
 #*                       SNOWFLAKES                                    *
 #***********************************************************************
 
-snowflakes = []  # List to hold snowflake properties
-for _ in range(int(200*SCALE_FACTOR)):
-    snowflakes.append({
-        "x": random.randint(0, SCREEN_WIDTH),  # Random x position
-        "y": random.randint(0, SCREEN_HEIGHT),  # Random y position
-        "size": random.randint(2, 5),  # Random size
-        "speed": random.uniform(1, 3)  # Random fall speed
-    })
+snowflake_count = options.snowflakes
+if snowflake_count is None:
+    snowflake_count = int(200*SCALE_FACTOR)
+snow = SnowParticles(snowflake_count, SCREEN_WIDTH, SCREEN_HEIGHT, SCALE_FACTOR, random.getrandbits(32))
 
 #***********************************************************************
 #*                       FIREPLACE/SHIELDS SETUP                       *
 #***********************************************************************
-fireplace_image = load_image("media/graphics/fireplace_small.png", SCALE_FACTOR, SCALE_FACTOR)
+fireplace_image = assets.load("media/graphics/fireplace_small.png")
 fireplace_width, fireplace_height = fireplace_image.get_size()
 fireplace_width, fireplace_height = fireplace_image.get_size()
 fireplace_y = player_rect.y-fireplace_height-(50*SCALE_FACTOR) 
 
-fireplaces = []
+fireplace_template = make_fireplace_template()
 fireplaces = make_fireplaces_array()
 
 
 #***********************************************************************
 #*                       PRESENT/ENEMY BULLETS SETUP                   *
 #***********************************************************************
-present_image = load_image("media/graphics/present_small.png", SCALE_FACTOR, SCALE_FACTOR)
-present_mask = pygame.mask.from_surface(present_image)
+present_image = assets.load("media/graphics/present_small.png")
+present_mask = get_mask(present_image)
 present_width, present_height = present_image.get_size()
 present_width, present_height = present_image.get_size()
-present_list = []
+# presents and explosions come from fixed size pools so that nothing is
+# allocated for them while the game runs
+PRESENT_POOL_SIZE = 128
+present_pool = EntityPool(PRESENT_POOL_SIZE, present_width, present_height)
 
 #***********************************************************************
 #*                       EXPLOSION GRAPHICS                            *
 #***********************************************************************
 explosion_graphics =[]
-explosion_list = []
 for i in range(7):
-    filename = "media/graphics/explosion"+str(i+1)+".png"
-    explosion =  load_image(filename, SCALE_FACTOR, SCALE_FACTOR)
+    explosion = assets.load(EXPLOSION_FILES[i])
     explosion_graphics.append(explosion)
+
+# anything that moves further than this in one step jumped there and is
+# drawn at its new position rather than slid across the screen
+INTERPOLATION_SNAP_DISTANCE = 100 * SCALE_FACTOR
+
+EXPLOSION_POOL_SIZE = 64
+explosion_pool = EntityPool(EXPLOSION_POOL_SIZE, explosion_graphics[0].get_width(), 
+                            explosion_graphics[0].get_height())
+
+# precompute the erosion brushes for the star/present and the bag hits
+erosion_brushes = {}
+get_erosion_brush(explosion_graphics[0].get_width()//4)
+get_erosion_brush(explosion_graphics[0].get_width()//3)
               
+startup_times["ready"] = time.perf_counter() - STARTUP_START
+if "title" in startup_times:
+    print(f"Title screen after {startup_times['title']*1000:.0f} ms, ", end="")
+print(f"assets loaded after {startup_times['assets']*1000:.0f} ms, "
+      f"ready after {startup_times['ready']*1000:.0f} ms")
+
 #***********************************************************************
 #*                       START GAME!!!                                 *
 #***********************************************************************
 
 clock = pygame.time.Clock()
 
-game_data["game_state"] != GAME_STATE_TITLE
-
-while game_data["game_state"] != GAME_STATE_QUIT:
+def main():
+    # read the high scores now so the game over screen doesn't wait on the disk
+    high_score_store.load()
+    print("Welcome to Santavaders!")
+    print("DO NOT CLOSE THIS WINDOW WHILE GAME IS PLAYING")
+    print("Left and Right = Arrow Keys")
+    print("Fire = SPACE bar or UP arrow")
+    print("Profiling overlay = 'F' key")
+    print("Save profile to CSV = 'C' key")
+    if UPSCALING:
+        print("Change how the game is scaled up = 'U' key")
+
+    if input_log["replay"] is not None:
+        start_new_game()  # straight into the replay, no title screen
+
+    while game_data["game_state"] != GAME_STATE_QUIT:
+        state = game_data["game_state"]
+        hooks = GAME_STATES[state]
+        if state != state_data["current"]:
+            state_data["current"] = state
+            state_data["deadline"] = None
+            state_data["redraw"] = True
+            if hooks["enter"]:
+                hooks["enter"]()
+
+        if hooks["idle"]:
+            # sleep until something happens or the state's timer runs out
+            timeout = IDLE_WAIT_MS
+            if state_data["deadline"] is not None:
+                timeout = min(timeout, state_data["deadline"] - pygame.time.get_ticks())
+            events = wait_for_events(timeout)
+        else:
+            events = pygame.event.get()
 
-    # Did the user click the window close button?
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            game_data["game_state"] = GAME_STATE_QUIT
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
+        for event in events:
+            # Did the user click the window close button?
+            if event.type == pygame.QUIT:
                 game_data["game_state"] = GAME_STATE_QUIT
-            if event.key == pygame.K_p:
-                game_data["game_state"] = GAME_STATE_PAUSED
-            if event.key == pygame.K_f:
-                game_data["show_fps"] = not game_data["show_fps"]
-        if event.type == END_MUSIC_EVENT:
-            play_next_song()
-            
-    if game_data["game_state"] == GAME_STATE_GAME_OVER:
-        game_over()
-    elif game_data["game_state"]  == GAME_STATE_PAUSED:
-        display_pause_screen()
-    elif game_data["game_state"]  == GAME_STATE_TITLE:
-        display_title_screen()
-    elif game_data["game_state"]  == GAME_STATE_RUNNING:
-        get_input()
-        update()
-        detect_collisions()
-        draw_scene()
-        pygame.display.update()
-        check_level_end()
-        dt=clock.tick(60)
-
-# Done! Time to quit.
-print("Goodbye!!")
-pygame.quit()
-
+            if event.type == END_MUSIC_EVENT:
+                music_player.play_next()
+            if event.type == pygame.WINDOWEXPOSED:
+                state_data["redraw"] = True
+            # events after a state change are dropped so one key press can't
+            # act on two screens
+            if hooks["event"] and game_data["game_state"] == state:
+                hooks["event"](event)
+
+        if game_data["game_state"] == state and hooks["update"]:
+            hooks["update"]()
+        if (game_data["game_state"] == state and hooks["draw"]
+                and (state_data["redraw"] or not hooks["idle"])):
+            hooks["draw"]()
+            state_data["redraw"] = False
+
+    # Done! Time to quit.
+    finish_recording()
+    high_score_store.flush()
+    print("Goodbye!!")
+    pygame.quit()
+
+def headless_main():
+    start_time = time.perf_counter()
+    if replay_recording is not None:
+        frames = replay_headless(replay_recording)
+    elif options.record:
+        frames = record_headless(options.frames, options.record)
+    else:
+        frames = run_headless(options.frames)
+    elapsed = time.perf_counter() - start_time
+    seed = options.seed if replay_recording is None else replay_recording.seed
+    print(f"Simulated {frames} frames with seed {seed} in {elapsed:.2f}s "
+          f"({frames / elapsed:.0f} frames/s)")
+    print(f"Level {game_data['current_level'] + 1}, score {game_data['player_score']}")
+    pygame.quit()
+
+if __name__ == "__main__":
+    if HEADLESS:
+        headless_main()
+    else:
+        main()
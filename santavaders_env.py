@@ -0,0 +1,309 @@
+# ***********************************************************************
+# Santavaders environment for game playing bots
+# Copyright (C) 2024 by David Culp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#<https://www.gnu.org/licenses/>.
+# ***********************************************************************
+"""Drive Santavaders one simulation step at a time, the way gym does.
+
+SantavadersEnv wraps a headless game with reset(seed) and step(action),
+returning (observation, reward, terminated, truncated, info) like a
+gymnasium environment.  An action is any combination of the game's
+INPUT_LEFT, INPUT_RIGHT and INPUT_FIRE bits, so there are 8 of them.  The
+reward is the change in player_score.  Observations are a dict of NumPy
+arrays with fixed shapes, listed by observation_spec():
+
+    formation   uint8   (rows, cols)  1 where an invader is alive
+    state       float32 (STATE_FIELDS,) positions are fractions of the screen
+    presents    float32 (PRESENT_POOL_SIZE, 3) x, y, 1 for each falling present
+    fireplaces  float32 (fireplaces,) fraction of each fireplace shot away
+
+The game keeps its state in module globals, so a process can only hold
+one environment.  VectorEnv runs one per worker process, steps them all
+in one batched call and has them write their observations straight into
+shared memory.
+
+    python santavaders_env.py --envs 4        # measure steps per second
+"""
+import os
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import time
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy
+
+# bots never need a window or sound
+os.environ["SANTAVADERS_HEADLESS"] = "1"
+import santavaders as sv
+
+ACTIONS = 8  # every combination of the three action bits
+ACTION_BITS = sv.INPUT_LEFT | sv.INPUT_RIGHT | sv.INPUT_FIRE
+STATE_FIELDS = ("player_x", "formation_x", "formation_y", "formation_dir",
+                "star_active", "star_x", "star_y",
+                "bag_active", "bag_x", "bag_y",
+                "sleigh_active", "sleigh_x", "sleigh_y",
+                "level", "fireplaces_active")
+
+
+def observation_spec():
+    """Return {name: (shape, dtype)} for every observation array"""
+    return {"formation": ((sv.invaders.rows, sv.invaders.cols), numpy.uint8),
+            "state": ((len(STATE_FIELDS),), numpy.float32),
+            "presents": ((sv.PRESENT_POOL_SIZE, 3), numpy.float32),
+            "fireplaces": ((len(sv.fireplaces),), numpy.float32)}
+
+
+#***********************************************************************
+#*                       ENVIRONMENT                                   *
+#***********************************************************************
+class SantavadersEnv:
+    """The game in this process, advanced one fixed simulation step per step().
+
+    observation is a dict of arrays to write observations into, shaped as
+    observation_spec() says.  They are allocated when it isn't given.  The
+    arrays returned by reset() and step() are these same arrays, so copy
+    them to keep one past the next step.  max_steps ends an episode with
+    truncated set.
+    """
+    created = False
+
+    def __init__(self, observation=None, max_steps=None):
+        if SantavadersEnv.created:
+            raise RuntimeError("only one SantavadersEnv can run in a process, use VectorEnv")
+        SantavadersEnv.created = True
+        if observation is None:
+            observation = {name: numpy.zeros(shape, dtype)
+                           for name, (shape, dtype) in observation_spec().items()}
+        self.observation = observation
+        self.max_steps = max_steps
+        self.steps = 0
+        self.score = 0
+
+    def reset(self, seed=None):
+        """Start a new game, seeding the game's random numbers when seed is given"""
+        if seed is not None:
+            sv.random.seed(seed)
+        sv.reset_game(True)
+        self.steps = 0
+        self.score = 0
+        return self.observe(), self.info()
+
+    def step(self, action):
+        """Hold the keys for action for one simulation step"""
+        sv.advance_game_clock()
+        sv.get_input(sv.STEP_KEYS[action & ACTION_BITS])
+        sv.update()
+        sv.detect_collisions()
+        terminated = sv.game_data["game_state"] != sv.GAME_STATE_RUNNING
+        if not terminated:
+            sv.check_level_end()
+        self.steps += 1
+        truncated = not terminated and self.max_steps is not None and self.steps >= self.max_steps
+        score = sv.game_data["player_score"]
+        reward = score - self.score
+        self.score = score
+        return self.observe(), reward, terminated, truncated, self.info()
+
+    def info(self):
+        return {"score": self.score, "level": sv.game_data["current_level"], "steps": self.steps}
+
+    def observe(self):
+        """Write the current game into the observation arrays"""
+        observation = self.observation
+        width, height = sv.SCREEN_WIDTH, sv.SCREEN_HEIGHT
+        game_data = sv.game_data
+
+        formation = observation["formation"]
+        formation.reshape(-1)[:] = numpy.frombuffer(sv.invaders.active, numpy.uint8) != 0
+
+        state = observation["state"]
+        state[:] = (sv.player_rect.x / width,
+                    sv.invaders_pos[0] / width, sv.invaders_pos[1] / height,
+                    game_data["invaders_dir"],
+                    game_data["star_active"], sv.star_rect.x / width, sv.star_rect.y / height,
+                    game_data["guided_bag_active"], sv.bag_rect.x / width, sv.bag_rect.y / height,
+                    game_data["santa_sleigh_active"],
+                    sv.santa_sleigh_rect.x / width, sv.santa_sleigh_rect.y / height,
+                    game_data["current_level"], game_data["fireplaces_active"])
+
+        presents = observation["presents"]
+        presents[:] = 0
+        for i, present in enumerate(sv.present_pool):
+            presents[i] = (present.rect.x / width, present.rect.y / height, 1)
+
+        damage = observation["fireplaces"]
+        for i, fireplace in enumerate(sv.fireplaces):
+            damage[i] = sv.fireplace_damage(fireplace)
+        return observation
+
+
+#***********************************************************************
+#*                       VECTORIZED RUNNER                             *
+#***********************************************************************
+def buffer_layout(num_envs):
+    """Lay out one shared memory block holding every environment's
+    observation, reward and end flags.
+
+    Returns {name: (offset, shape, dtype)} and the block's size in bytes.
+    """
+    arrays = {name: ((num_envs,) + shape, dtype)
+              for name, (shape, dtype) in observation_spec().items()}
+    arrays["reward"] = ((num_envs,), numpy.float32)
+    arrays["terminated"] = ((num_envs,), numpy.bool_)
+    arrays["truncated"] = ((num_envs,), numpy.bool_)
+    layout = {}
+    offset = 0
+    for name, (shape, dtype) in arrays.items():
+        layout[name] = (offset, shape, dtype)
+        size = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        offset += (size + 63) // 64 * 64  # keep each array on its own cache lines
+    return layout, offset
+
+def map_buffers(memory, layout):
+    return {name: numpy.ndarray(shape, dtype, buffer=memory.buf, offset=offset)
+            for name, (offset, shape, dtype) in layout.items()}
+
+def worker(index, memory_name, num_envs, max_steps, connection):
+    """Run one environment, writing into row index of the shared arrays"""
+    memory = shared_memory.SharedMemory(name=memory_name)
+    layout, _ = buffer_layout(num_envs)
+    arrays = map_buffers(memory, layout)
+    env = SantavadersEnv({name: arrays[name][index] for name in observation_spec()}, max_steps)
+    try:
+        while True:
+            command, argument = connection.recv()
+            if command == "reset":
+                _, info = env.reset(argument)
+            elif command == "step":
+                _, reward, terminated, truncated, info = env.step(argument)
+                arrays["reward"][index] = reward
+                arrays["terminated"][index] = terminated
+                arrays["truncated"][index] = truncated
+                if terminated or truncated:
+                    # start the next episode straight away, as gym's vector
+                    # environments do, and pass on how the last one ended.
+                    # The reset overwrites this row, so the last observation
+                    # is copied out first
+                    final_observation = {name: arrays[name][index].copy()
+                                         for name in observation_spec()}
+                    final_info = info
+                    _, info = env.reset()
+                    info["final_observation"] = final_observation
+                    info["final_info"] = final_info
+            else:
+                break
+            connection.send(info)
+    finally:
+        del env, arrays  # the views must go before the memory can be closed
+        memory.close()
+
+class VectorEnv:
+    """num_envs games in their own processes, stepped together.
+
+    step() takes one action per environment and returns the observations
+    as arrays with a leading environment axis, along with the rewards and
+    end flags.  These arrays live in shared memory that the workers write
+    to directly, and are overwritten by the next step.  An environment
+    whose episode ends starts a new one at once, so its row of the
+    observation is already the new episode's first.  Its info has a copy
+    of the old episode's last observation under "final_observation" and
+    the old episode's info under "final_info".
+    """
+
+    def __init__(self, num_envs, max_steps=None):
+        self.num_envs = num_envs
+        layout, size = buffer_layout(num_envs)
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.arrays = map_buffers(self.memory, layout)
+        self.observation = {name: self.arrays[name] for name in observation_spec()}
+        # each worker imports the game afresh rather than copying this one
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        for index in range(num_envs):
+            parent, child = context.Pipe()
+            process = context.Process(target=worker, daemon=True,
+                                      args=(index, self.memory.name, num_envs, max_steps, child))
+            process.start()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def reset(self, seed=None):
+        """Reset every environment.  Environment i is seeded with seed + i"""
+        for index, connection in enumerate(self.connections):
+            connection.send(("reset", None if seed is None else seed + index))
+        return self.observation, [connection.recv() for connection in self.connections]
+
+    def step(self, actions):
+        for connection, action in zip(self.connections, actions):
+            connection.send(("step", int(action)))
+        infos = [connection.recv() for connection in self.connections]
+        return (self.observation, self.arrays["reward"], self.arrays["terminated"],
+                self.arrays["truncated"], infos)
+
+    def close(self):
+        try:
+            for connection in self.connections:
+                try:
+                    connection.send(("close", None))
+                except OSError:
+                    pass  # that worker has already died
+            for process in self.processes:
+                process.join()
+        finally:
+            del self.observation, self.arrays
+            self.memory.close()
+            self.memory.unlink()
+
+
+#***********************************************************************
+#*                       THROUGHPUT CHECK                              *
+#***********************************************************************
+def measure(num_envs, steps, seed):
+    """Return environment steps per second with random actions"""
+    rng = numpy.random.default_rng(seed)
+    if num_envs == 0:
+        env = SantavadersEnv()
+        env.reset(seed)
+        start = time.perf_counter()
+        for action in rng.integers(0, ACTIONS, steps):
+            _, _, terminated, truncated, _ = env.step(int(action))
+            if terminated or truncated:
+                env.reset()
+        return steps / (time.perf_counter() - start)
+    envs = VectorEnv(num_envs)
+    try:
+        envs.reset(seed)
+        start = time.perf_counter()
+        for _ in range(steps // num_envs):
+            envs.step(rng.integers(0, ACTIONS, num_envs))
+        return (steps // num_envs) * num_envs / (time.perf_counter() - start)
+    finally:
+        envs.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Santavaders environment throughput")
+    parser.add_argument("--envs", type=int, default=os.cpu_count(),
+                        help="environments in the vectorized runner")
+    parser.add_argument("--steps", type=int, default=20000,
+                        help="environment steps to time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(f"in process: {measure(0, args.steps, args.seed):9.0f} steps/s")
+    print(f"{args.envs} processes: {measure(args.envs, args.steps, args.seed):9.0f} steps/s "
+          f"on {os.cpu_count()} cores")
+
+
+if __name__ == "__main__":
+    main()